@@ -1,62 +1,46 @@
 """
 This performs the entire ETL process from scraping energy data,
 to parsing, to storing on MongoDB.
+
+Each step is a function so that pipeline.py can run them as separate,
+cached stages. Running this file directly runs the whole pipeline:
+
+    python ETL.py
 """
 
 import json
-import pandas as pd
-import numpy as np
 import re
-import requests
-import time
-from bs4 import BeautifulSoup as BS
+import hashlib
 import pymongo
 from pprint import pprint
-%load_ext autoreload
-%autoreload 2
 import helper_functions
 
 """
 GETTING STARTED
 ---------------
-Do a little manipulation to the text file from EIA containing 
-all of their data. It is a text file with a bunch of line-separated 
-JSON objects, but I massage it here to a proper JSON and export it 
-as a new file.
+The text file from EIA containing all of their data is a bunch of
+line-separated JSON objects, so each line is parsed on its own.
 """
 
-lastline = None
-
-# Open and read text file
-with open("not_for_git/SEDS.txt","r") as f:
-    lineList = f.readlines()
-    
-    # Keep track of last line
-    lastline=lineList[-1]
-
-# Open text file and create new json to be written
-with open("not_for_git/SEDS.txt","r") as f, open("not_for_git/cleanfile2.json","w") as g:
-    
-    # Iterate through each line of the text file
-    for i,line in enumerate(f,0):
-        
-        # First line gets [ and , to initialize the json
-        if i == 0:
-            line = "["+str(line)+","
-            g.write(line)
-            
-        # Last line gets ] to signal the end of the json
-        elif line == lastline:            
-            g.write(line)
-            g.write("]")
-            
-        # Other lines get comma separation
-        else:
-            line = str(line)+","
-            g.write(line)
-
-file = open('not_for_git/cleanfile2.json', 'r')
-json_data = json.load(file)
+SEDS_PATH = 'not_for_git/SEDS.txt'
+
+
+def parse_seds(seds_path=SEDS_PATH):
+    """
+    Returns
+    -------
+
+        A list with one dict per series in the EIA SEDS bulk file.
+
+    Parameters
+    -----------
+
+        seds_path: [str] Path to the SEDS text file
+    """
+    with open(seds_path, 'r') as f:
+        json_data = [json.loads(line) for line in f if line.strip()]
+
+    return json_data
 
 """
 ASSIGN ENERGY TYPES
@@ -81,7 +65,7 @@ energy_types = [
 # Make all lowercase in case some pages have inconsistent letter casing
 for i in range(len(energy_types)):
     energy_types[i] = energy_types[i].lower()
-    
+
 # Assign nonrenewable and renewable based on EIA
 nonrenewable_energies = energy_types[:4]
 renewable_energies = energy_types[4:]
@@ -96,91 +80,126 @@ headers = {'user-agent': 'Safari/13.0.2 (Macintosh; Intel Mac OS X 10_15)'}
 base_url = 'https://www.eia.gov/opendata/qb.php'
 consumption_suffix = '?category=40204'
 
-# Scrape the consumption page
-consumption_page = helper_functions.get_page(base_url+consumption_suffix,headers)
-
-# Create empty dict to store all info across every sector and energy type by state
-env_series_ids = {}
-
-# Start by scraping the consumption website in order to get the list of available sectors  
-consumption_sectors = consumption_page.find('div',{'class':'pagecontent mr_temp2'})
-
-# Store sector url suffixes in a list
-sector_url_suffixes = [sector.a['href'] for sector in consumption_sectors.find_all('li')[:7]]
-
-# Loop 1 - iterate through each sector
-for sector_url_suffix in sector_url_suffixes:
-    
-    # Scrape the sector page
-    sector_page = helper_functions.get_page(base_url+sector_url_suffix,headers)    
-
-    # Go into first url and grab tags of all children categories
-    children_categories = sector_page.find('div',{'class':'main_col'}).ul.find_all('li')
-
-    # Store the urls of children cats (ccats = children categories)
-    ccats_url_suffixes = [children_category.a['href'] 
-                          for children_category in children_categories
-                          if children_category.text.lower() in energy_types]
-    
-    # Loop 2 - for each sector, iterate through the relevant types of energy consumption to get state-level data
-    for ccats_url_suffix in ccats_url_suffixes:
-        
-        # Scrape the child category page
-        child_category_page = helper_functions.get_page(base_url+ccats_url_suffix,headers)
-
-        # Grab tags of all energy unit children categories. Only want Btu
-        energy_unit_cats = child_category_page.find('div',{'class':'main_col'}).ul.find_all('li')
-
-        # Store only the url of the 'Btu' children category. I make a list and select only the first element 
-        # because sometimes there will be two energy unit options or just one. This way ensures we only take 
-        # the Btu option.
-        btu_url_suffix = [energy_unit.a['href'] 
-                   for energy_unit in energy_unit_cats
-                   if energy_unit.text == 'Btu'][0]
-        
-        # Scrape the Btu page
-        btu_page = helper_functions.get_page(base_url+btu_url_suffix,headers)
-        
-        # Get list of states by their tags
-        states = btu_page.find('div',{'class':'main_col'}).ul.find_all('li')
-        
-        # Get url suffixes for each state
-        state_url_suffixes = [state.a['href'] for state in states]
-        
-        # Isolate the sector and energy type
-        sector = btu_page.find('div',{'class':'main_col'}).h3.find_all('a')[3].text
-        energy_type = btu_page.find('div',{'class':'main_col'}).h3.find_all('a')[4].text
-        
-        # Add these to a dict which will be the values of the overarching env_series_ids dict
-        series_id_values = {'sector':sector,'energy_type':energy_type}
-        
-        # Parse through url suffixes to get and store the series ids we want to use to parse the big JSON
-        for state_suffix in state_url_suffixes:
-            series_id = re.findall('SEDS.*',state_suffix)[0]
-            env_series_ids[series_id] = series_id_values    
+
+def crawl_series_ids(base_url=base_url, headers=headers):
+    """
+    Returns
+    -------
+
+        A dict of the form {series_id: {'sector': sector, 'energy_type': energy_type}}
+        for every state-level consumption series we care about.
+
+    Parameters
+    -----------
+
+        base_url: [str] EIA query browser url
+
+        headers: [dict] headers to pass into requests.get
+    """
+    # Scrape the consumption page
+    consumption_page = helper_functions.get_page(base_url+consumption_suffix,headers)
+
+    # Create empty dict to store all info across every sector and energy type by state
+    env_series_ids = {}
+
+    # Start by scraping the consumption website in order to get the list of available sectors
+    consumption_sectors = consumption_page.find('div',{'class':'pagecontent mr_temp2'})
+
+    # Store sector url suffixes in a list
+    sector_url_suffixes = [sector.a['href'] for sector in consumption_sectors.find_all('li')[:7]]
+
+    # Loop 1 - iterate through each sector
+    for sector_url_suffix in sector_url_suffixes:
+
+        # Scrape the sector page
+        sector_page = helper_functions.get_page(base_url+sector_url_suffix,headers)
+
+        # Go into first url and grab tags of all children categories
+        children_categories = sector_page.find('div',{'class':'main_col'}).ul.find_all('li')
+
+        # Store the urls of children cats (ccats = children categories)
+        ccats_url_suffixes = [children_category.a['href']
+                              for children_category in children_categories
+                              if children_category.text.lower() in energy_types]
+
+        # Loop 2 - for each sector, iterate through the relevant types of energy consumption to get state-level data
+        for ccats_url_suffix in ccats_url_suffixes:
+
+            # Scrape the child category page
+            child_category_page = helper_functions.get_page(base_url+ccats_url_suffix,headers)
+
+            # Grab tags of all energy unit children categories. Only want Btu
+            energy_unit_cats = child_category_page.find('div',{'class':'main_col'}).ul.find_all('li')
+
+            # Store only the url of the 'Btu' children category. I make a list and select only the first element
+            # because sometimes there will be two energy unit options or just one. This way ensures we only take
+            # the Btu option.
+            btu_url_suffix = [energy_unit.a['href']
+                       for energy_unit in energy_unit_cats
+                       if energy_unit.text == 'Btu'][0]
+
+            # Scrape the Btu page
+            btu_page = helper_functions.get_page(base_url+btu_url_suffix,headers)
+
+            # Get list of states by their tags
+            states = btu_page.find('div',{'class':'main_col'}).ul.find_all('li')
+
+            # Get url suffixes for each state
+            state_url_suffixes = [state.a['href'] for state in states]
+
+            # Isolate the sector and energy type
+            sector = btu_page.find('div',{'class':'main_col'}).h3.find_all('a')[3].text
+            energy_type = btu_page.find('div',{'class':'main_col'}).h3.find_all('a')[4].text
+
+            # Add these to a dict which will be the values of the overarching env_series_ids dict
+            series_id_values = {'sector':sector,'energy_type':energy_type}
+
+            # Parse through url suffixes to get and store the series ids we want to use to parse the big JSON
+            for state_suffix in state_url_suffixes:
+                series_id = re.findall('SEDS.*',state_suffix)[0]
+                env_series_ids[series_id] = series_id_values
+
+    return env_series_ids
 
 """
 PARSE DATA
 ----------
 """
 
-# Set up empty bucket for parsed data
-environmental_data = []
-
-# Iterate through big json to parse relevant info
-for single_json in json_data:
-    
-    # Only parse entries that have the series ids that we care about
-    if single_json.get('series_id') in env_series_ids.keys():
-        single_data_entry = {}
-        single_data_entry['series_id'] = single_json['series_id']
-        single_data_entry['sector'] = env_series_ids[single_json['series_id']]['sector']
-        single_data_entry['data'] = single_json['data']
-        single_data_entry['state'] = re.findall('(, )(\w* ?\w* ?\w*)',single_json['name'])[-1][-1]
-        single_data_entry['units'] = single_json['units']
-        single_data_entry['energy_type'] = env_series_ids[single_json['series_id']]['energy_type']
-        
-        environmental_data.append(single_data_entry)
+
+def map_series(json_data, env_series_ids):
+    """
+    Returns
+    -------
+
+        A list of documents, one per series in env_series_ids, ready to be inserted into MongoDB.
+
+    Parameters
+    -----------
+
+        json_data: [list] Output of parse_seds()
+
+        env_series_ids: [dict] Output of crawl_series_ids()
+    """
+    # Set up empty bucket for parsed data
+    environmental_data = []
+
+    # Iterate through big json to parse relevant info
+    for single_json in json_data:
+
+        # Only parse entries that have the series ids that we care about
+        if single_json.get('series_id') in env_series_ids.keys():
+            single_data_entry = {}
+            single_data_entry['series_id'] = single_json['series_id']
+            single_data_entry['sector'] = env_series_ids[single_json['series_id']]['sector']
+            single_data_entry['data'] = single_json['data']
+            single_data_entry['state'] = re.findall('(, )(\w* ?\w* ?\w*)',single_json['name'])[-1][-1]
+            single_data_entry['units'] = single_json['units']
+            single_data_entry['energy_type'] = env_series_ids[single_json['series_id']]['energy_type']
+
+            environmental_data.append(single_data_entry)
+
+    return environmental_data
 
 """
 STORE DATA TO MONGODB
@@ -189,15 +208,62 @@ This is to a localhost though, so you'll need to install MongoDB
 for yourself in order to do this.
 """
 
-client = pymongo.MongoClient('mongodb://localhost/')
-db = client.admin
 
-# Issue the serverStatus command and print the results
-serverStatusResult=db.command("serverStatus")
-pprint(serverStatusResult)
+def load_series(environmental_data, mongo_url='mongodb://localhost/', packed=False):
+    """
+    Returns
+    -------
+
+        A dict with the number of documents stored and the dataset version stamp.
+
+        Series are upserted by series_id, so loading the same data twice
+        (e.g. when resuming a pipeline run) doesn't create duplicates. A
+        version stamp derived from the loaded data is written to the 'meta'
+        collection so readers can tell when the dataset has changed.
+
+    Parameters
+    -----------
+
+        environmental_data: [list] Output of map_series()
+
+        mongo_url: [str] MongoDB connection string
+
+        packed: [bool] Store each series' values as packed float64 bytes instead of a list
+                of [year, value] pairs. See helper_functions.encode_series_data().
+    """
+    client = pymongo.MongoClient(mongo_url)
+    db = client.admin
+
+    # Issue the serverStatus command and print the results
+    serverStatusResult=db.command("serverStatus")
+    pprint(serverStatusResult)
+
+    mydb = client['energy_data']
+
+    energy_collection = mydb['energy_data']
+
+    documents = environmental_data
+    if packed:
+        documents = [{**{key: value for key, value in document.items() if key != 'data'},
+                      **helper_functions.encode_series_data(document['data'])}
+                     for document in environmental_data]
+
+    requests = [pymongo.ReplaceOne({'series_id': document['series_id']}, document, upsert=True)
+                for document in documents]
+    energy_collection.bulk_write(requests)
+
+    # Version stamp: a hash of every series id and its data
+    digest = hashlib.sha1()
+    for document in sorted(environmental_data, key=lambda document: document['series_id']):
+        digest.update(document['series_id'].encode())
+        digest.update(json.dumps(document['data']).encode())
+    version = digest.hexdigest()
+
+    mydb['meta'].replace_one({'_id': 'dataset_version'}, {'_id': 'dataset_version', 'version': version}, upsert=True)
 
-mydb = client['energy_data']
+    return {'n_documents': len(environmental_data), 'version': version}
 
-energy_collection = mydb['energy_data']
 
-env_results = energy_collection.insert_many(environmental_data)
\ No newline at end of file
+if __name__ == '__main__':
+    import pipeline
+    pipeline.main()
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import sys
+
+import caching
+import helper_functions
+
+
+"""
+ANALYSIS SESSION
+----------------
+
+    get_sustainability_df() calls get_sustainability_indicators(), which
+    calls get_states_data(), which queries MongoDB for every state and builds
+    every dataframe again. A session remembers the result of each step of
+    that chain:
+
+        documents -> states_data -> sus_indicators -> sus_df
+
+    Everything is keyed on the dataset version the ETL stamps into MongoDB,
+    so as soon as the ETL loads new data every step is recomputed, and until
+    then repeated notebook cells and app start-ups get the stored results.
+    With a cache_dir, results also survive restarts of the kernel or the app.
+    Persisted results are also keyed on the code that builds them, so they
+    are recomputed after helper_functions or this module changes.
+
+    Usage:
+
+        session = AnalysisSession(cache_dir='cleaned_data/cache')
+        sus_df = session.get_sustainability_df()
+"""
+
+# Steps of the chain, each computed from the one before it
+levels = ['documents', 'states_data', 'sus_indicators', 'sus_df']
+
+# Modules whose code decides what each step returns
+code_modules = [helper_functions, sys.modules[__name__]]
+
+
+def get_code_version():
+    """
+    Returns
+    -------
+
+        A hex digest of the code of every module in code_modules.
+    """
+    digest = hashlib.sha1()
+
+    for module in code_modules:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+class AnalysisSession:
+    """
+    Memoizes every step from the raw MongoDB documents to the sustainability index table.
+    """
+
+    def __init__(self, collection=None, cache_dir=None):
+        """
+        Parameters
+        -----------
+
+            collection: [pymongo.collection.Collection] Energy collection. Defaults to
+                        helper_functions.energy_collection
+
+            cache_dir: [str] Directory to persist results to. Results are only kept in
+                       memory if not given.
+        """
+        self.collection = collection if collection is not None else helper_functions.energy_collection
+        self.cache_dir = cache_dir
+        self.version = None
+        self.code_version = get_code_version()
+        self.results = {}
+
+        self.builders = {'documents': lambda: helper_functions.get_states_documents(self.collection),
+                         'states_data': lambda: helper_functions.get_states_data(self.get_documents()),
+                         'sus_indicators': lambda: helper_functions.get_sustainability_indicators(
+                                                       self.get_states_data()),
+                         'sus_df': lambda: helper_functions.get_sustainability_df(
+                                               self.get_sustainability_indicators())}
+
+    def get_version(self):
+        """
+        Returns
+        -------
+
+            The dataset version stamped by the ETL, or None if the data was
+            loaded without one (in which case nothing is persisted).
+        """
+        stamp = self.collection.database['meta'].find_one({'_id': 'dataset_version'})
+
+        return stamp and stamp['version']
+
+    def get(self, level):
+        """
+        Returns
+        -------
+
+            The result of the given step, computing it (and the steps it depends on) only if needed.
+
+        Parameters
+        -----------
+
+            level: [str] One of 'documents', 'states_data', 'sus_indicators', 'sus_df'
+        """
+        assert level in levels, f'level must be one of {levels}'
+
+        # New data since the results were computed, so none of them apply anymore
+        version = self.get_version()
+        if version != self.version:
+            self.results = {}
+            self.version = version
+
+        if level in self.results:
+            return self.results[level]
+
+        cache_name = 'session_' + level
+        cached = None
+        if self.cache_dir is not None and version is not None:
+            cached = caching.load_cache(cache_name, self.cache_dir)
+
+        if (cached is not None and cached['version'] == version
+                and cached.get('code_version') == self.code_version):
+            result = cached['result']
+        else:
+            result = self.builders[level]()
+            if self.cache_dir is not None and version is not None:
+                caching.save_cache(cache_name, {'version': version, 'code_version': self.code_version,
+                                                'result': result}, self.cache_dir)
+
+        self.results[level] = result
+
+        return result
+
+    def get_documents(self):
+        """
+        Returns
+        -------
+
+            Output of helper_functions.get_states_documents()
+        """
+        return self.get('documents')
+
+    def get_states_data(self):
+        """
+        Returns
+        -------
+
+            Output of helper_functions.get_states_data(). The dataframes are shared
+            with the session, so copy them before modifying them.
+        """
+        return self.get('states_data')
+
+    def get_sustainability_indicators(self):
+        """
+        Returns
+        -------
+
+            Output of helper_functions.get_sustainability_indicators()
+        """
+        return self.get('sus_indicators')
+
+    def get_sustainability_df(self):
+        """
+        Returns
+        -------
+
+            Output of helper_functions.get_sustainability_df(), as a copy that can be modified freely.
+        """
+        return self.get('sus_df').copy()
+
+    def invalidate(self, level='documents'):
+        """
+        Forgets the given step and every step after it, in memory and on disk,
+        so they are recomputed on next use.
+
+        Parameters
+        -----------
+
+            level: [str] First step to forget. Defaults to everything.
+        """
+        assert level in levels, f'level must be one of {levels}'
+
+        for dropped in levels[levels.index(level):]:
+            self.results.pop(dropped, None)
+
+            if self.cache_dir is not None:
+                path = os.path.join(self.cache_dir, 'session_' + dropped + '.pickle')
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,300 @@
+"""
+Read-only JSON API over the energy dataset.
+
+Endpoints (all GET):
+
+    /api/v1/states                   list of states, sectors and energy types
+    /api/v1/series                   consumption records, filtered by
+                                     state, sector, energy_type, start, end
+    /api/v1/sustainability           the sustainability table
+
+/series and /sustainability are paginated with limit and offset.
+
+Every response carries a strong ETag derived from the dataset version and
+the query, so clients that send If-None-Match get a 304 without anything
+being computed. Response bodies (plain and gzipped) are kept in an
+in-process LRU cache, so repeat requests are a dictionary lookup. The
+filtered record lists behind the paginated endpoints are cached separately,
+without the pagination, so paging through a result only filters it once.
+
+The API is mounted on the dash app's Flask server by app.py. It can also
+run on its own:
+
+    python api.py --port 8051
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from flask import Blueprint, Flask, Response, abort, jsonify, request
+
+MAX_LIMIT = 10000
+DEFAULT_LIMIT = 1000
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache. Holds {key: [body, gzipped body]} for
+    responses, where the gzipped body is only computed the first time a
+    client asks for it, and {key: records} for filtered record lists.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def get_series_records(states_data, state=None, sector=None, energy_type=None, start=None, end=None):
+    """
+    Returns
+    -------
+
+        A list of {'state', 'sector', 'energy_type', 'year', 'value'} records for every
+        matching series, in state, sector, energy type, year order.
+
+    Parameters
+    -----------
+
+        states_data: [dict] {state: {sector: dataframe}}
+
+        state, sector, energy_type: [list] Only return these. None means all.
+
+        start, end: [int] Year range (inclusive). None means unbounded.
+    """
+    records = []
+
+    for state_name in sorted(states_data):
+        if state and state_name not in state:
+            continue
+
+        for sector_name in sorted(states_data[state_name]):
+            if sector and sector_name not in sector:
+                continue
+
+            df = states_data[state_name][sector_name].sort_index()
+            years = np.array(df.index.year)
+            in_range = np.ones(len(years), dtype=bool)
+            if start is not None:
+                in_range &= years >= start
+            if end is not None:
+                in_range &= years <= end
+
+            for column in sorted(df.columns):
+                if energy_type and column not in energy_type:
+                    continue
+
+                values = df[column].values[in_range]
+                records.extend({'state': state_name,
+                                'sector': sector_name,
+                                'energy_type': column,
+                                'year': int(year),
+                                'value': None if np.isnan(value) else float(value)}
+                               for year, value in zip(years[in_range], values.astype(float)))
+
+    return records
+
+
+def paginate(records, limit, offset):
+    """
+    Returns
+    -------
+
+        A dict with one page of records and the pagination fields.
+    """
+    page = records[offset:offset + limit]
+    next_offset = offset + limit if offset + limit < len(records) else None
+
+    return {'total': len(records), 'limit': limit, 'offset': offset, 'next_offset': next_offset, 'data': page}
+
+
+def create_api_blueprint(get_data, cache_entries=1024, record_cache_entries=8):
+    """
+    Returns
+    -------
+
+        A Flask blueprint serving the API.
+
+    Parameters
+    -----------
+
+        get_data: [callable] Returns a tuple (states_data, sus_df, dataset_version). Called
+                  on every request, so the data behind the API can be swapped at runtime.
+                  Cached responses are keyed on the version, so a new version is never
+                  served from stale cache entries.
+
+        cache_entries: [int] Maximum number of responses kept in the cache
+
+        record_cache_entries: [int] Maximum number of filtered record lists kept in the cache.
+                              A list of every record is large, so keep this small.
+    """
+    api = Blueprint('api', __name__, url_prefix='/api/v1')
+    cache = ResponseCache(cache_entries)
+    record_cache = ResponseCache(record_cache_entries)
+    api.response_cache = cache
+    api.record_cache = record_cache
+
+    @api.errorhandler(400)
+    def bad_request(error):
+        return jsonify({'error': error.description}), 400
+
+    def get_list_arg(name):
+        values = request.args.getlist(name)
+        return tuple(sorted(values)) or None
+
+    def get_int_arg(name, default=None, minimum=None, maximum=None):
+        value = request.args.get(name)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            abort(400, description=f'{name} must be an integer, got {value!r}')
+        if minimum is not None:
+            value = max(value, minimum)
+        if maximum is not None:
+            value = min(value, maximum)
+        return value
+
+    def respond(endpoint, params, build):
+        """
+        Serves a cached (or freshly built) JSON body with ETag and gzip handling.
+        """
+        states_data, sus_df, version = get_data()
+
+        key = json.dumps([version, endpoint, params], sort_keys=True)
+        use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+
+        # Strong validators must differ between representations, so the gzipped body gets its own tag
+        etag = '"' + hashlib.sha1(key.encode()).hexdigest() + ('-gzip' if use_gzip else '') + '"'
+
+        headers = {'ETag': etag, 'Cache-Control': 'public, max-age=0, must-revalidate', 'Vary': 'Accept-Encoding'}
+
+        # The client already has this exact response
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            return Response(status=304, headers=headers)
+
+        entry = cache.get(key)
+        if entry is None:
+            body = json.dumps(build(states_data, sus_df, version), separators=(',', ':')).encode()
+            entry = [body, None]
+            cache.put(key, entry)
+
+        if use_gzip:
+            if entry[1] is None:
+                entry[1] = gzip.compress(entry[0], compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+            return Response(entry[1], mimetype='application/json', headers=headers)
+
+        return Response(entry[0], mimetype='application/json', headers=headers)
+
+    def get_records(endpoint, filters, version, build_records):
+        """
+        Returns the full filtered record list, cached without the pagination
+        so every page of the same query slices the same list.
+        """
+        key = json.dumps([version, endpoint, filters], sort_keys=True)
+
+        records = record_cache.get(key)
+        if records is None:
+            records = build_records()
+            record_cache.put(key, records)
+
+        return records
+
+    @api.route('/states')
+    def states():
+        def build(states_data, sus_df, version):
+            first_state = next(iter(states_data.values()))
+            return {'states': sorted(states_data),
+                    'sectors': sorted(first_state),
+                    'energy_types': sorted({column for df in first_state.values() for column in df.columns})}
+
+        return respond('states', {}, build)
+
+    @api.route('/series')
+    def series():
+        filters = {'state': get_list_arg('state'),
+                   'sector': get_list_arg('sector'),
+                   'energy_type': get_list_arg('energy_type'),
+                   'start': get_int_arg('start'),
+                   'end': get_int_arg('end')}
+        limit = get_int_arg('limit', DEFAULT_LIMIT, 1, MAX_LIMIT)
+        offset = get_int_arg('offset', 0, 0)
+
+        def build(states_data, sus_df, version):
+            records = get_records('series', filters, version,
+                                  lambda: get_series_records(states_data, filters['state'], filters['sector'],
+                                                             filters['energy_type'], filters['start'], filters['end']))
+            return paginate(records, limit, offset)
+
+        return respond('series', dict(filters, limit=limit, offset=offset), build)
+
+    @api.route('/sustainability')
+    def sustainability():
+        filters = {'state': get_list_arg('state')}
+        limit = get_int_arg('limit', DEFAULT_LIMIT, 1, MAX_LIMIT)
+        offset = get_int_arg('offset', 0, 0)
+
+        def build_records(sus_df):
+            df = sus_df
+            if filters['state']:
+                df = df[df.index.isin(filters['state'])]
+            return json.loads(df.reset_index().rename(columns={'index': 'state'}).to_json(orient='records'))
+
+        def build(states_data, sus_df, version):
+            records = get_records('sustainability', filters, version, lambda: build_records(sus_df))
+            return paginate(records, limit, offset)
+
+        return respond('sustainability', dict(filters, limit=limit, offset=offset), build)
+
+    return api
+
+
+def main():
+    import argparse
+    import pickle
+
+    import caching
+    import helper_functions
+
+    parser = argparse.ArgumentParser(description='Serve the energy dataset as a read-only JSON API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8051)
+    args = parser.parse_args()
+
+    with open('cleaned_data/state_dfs.pickle', 'rb') as f:
+        states_data = pickle.load(f)
+
+    sus_df = helper_functions.get_sustainability_df()
+    data = (states_data, sus_df, caching.get_dataset_version(states_data))
+
+    server = Flask(__name__)
+    server.register_blueprint(create_api_blueprint(lambda: data))
+    server.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
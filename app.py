@@ -4,31 +4,67 @@ import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output, State
 import pandas as pd
+import flask
 
-import plotly.graph_objs as go
 import numpy as np
 import pymongo
-import helper_functions
-import re
+import scoring
+import figures
+import data_store
+import figure_bundle
+import api
 import csv
-import pickle
 
 state_abbrevs = open('state-abbreviations.csv')
 state_abbrevs_reader = csv.reader(state_abbrevs)
 state_abbrevs_dict = dict(state_abbrevs_reader)
 
-# Load sustainability df
-with open('cleaned_data/state_dfs.pickle', 'rb') as f:
-    states_data = pickle.load(f)
+# Everything the callbacks serve lives in one snapshot, which is swapped for a new
+# one in the background whenever the data on disk changes. States are read lazily from
+# a region store built from the pickle, so memory depends on which states are in use.
+store = data_store.DataStore('cleaned_data/state_dfs.pickle', source='regions', store_dir='cleaned_data/regions')
+store.watch(interval=30)
 
-# Store names of all possible sectors
-sectors = states_data['Alabama'].keys()
+# Figures prebuilt by figure_bundle.py, if a bundle has been built
+bundle = figure_bundle.load_bundle()
+
+def get_bundle(snapshot):
+    """
+    Returns the prebuilt bundle for the snapshot being served. After a hot reload
+    the bundle no longer matches, so the pointer is re-read in case the bundle has
+    been rebuilt for the new data (only a stat while it hasn't).
+    """
+    global bundle
+    if bundle is None or bundle.version != snapshot.version:
+        bundle = figure_bundle.reload_bundle(bundle)
+    return bundle
+
+def get_figure(snapshot, region, key, build):
+    """
+    Returns the figure from the prebuilt bundle if it has it for the data being
+    served, and otherwise from the figure cache, building it if needed.
+    """
+    bundle = get_bundle(snapshot)
+    if bundle is not None:
+        figure = bundle.get(snapshot.version, region, key)
+        if figure is not None:
+            return figure
+
+    # Cached under the state's fingerprint, so a reload only rebuilds states whose data changed.
+    # Figures that depend on every state (the map) are cached under the dataset version.
+    version = snapshot.version if region is None else snapshot.fingerprints[region]
+
+    return store.figures.get_or_build(region, version, key, build)
 
-sus_df = helper_functions.get_sustainability_df()
+# Store names of all possible sectors
+sectors = store.snapshot.states_data['Alabama'].keys()
 
 si_range = np.arange(0.0, 1.1, 0.1)
 si_range = np.round(si_range,1)
 
+score_years = store.snapshot.score_prefix_sums['years']
+default_window = figures.default_window
+
 
 
 navbar = dbc.NavbarSimple(
@@ -111,6 +147,32 @@ body = dbc.Container(
                                 'textAlign':'center',
                                 'display':'inline-block'
                             }
+                        ),
+                        html.P(
+                            children='Score years:',
+                            style={
+                                'margin-bottom': 0
+                            }
+                        ),
+                        dcc.RangeSlider(
+                            id='window_slider',
+                            min=score_years.min(),
+                            max=score_years.max(),
+                            value=default_window,
+                            marks={str(year): str(year) for year in score_years if year % 10 == 0},
+                            allowCross=False,
+                            # Keep the handles far enough apart for an effort score
+                            pushable=scoring.MIN_WINDOW_YEARS - 1,
+                            step=1
+                        ),
+                        dbc.RadioItems(
+                            id='map_layer_radio_item',
+                            options=[
+                                {'label': ' Sustainability Index ', 'value': 'si'},
+                                {'label': ' Consumption Profile Clusters ', 'value': 'cluster'}
+                            ],
+                            value='si',
+                            inline=True
                         )
 
                     ],
@@ -178,7 +240,9 @@ body = dbc.Container(
                                 # 'textAlign':'center',
                                 'display':'inline-block'
                             }
-                        )
+                        ),
+                        html.P(id='similar_states'),
+                        dcc.Graph(id="score_trajectory")
                     ],
                     width=4
                 ),
@@ -197,6 +261,22 @@ app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
 app.layout = html.Div([navbar, body])
 
+def get_api_data():
+    snapshot = store.snapshot
+    return snapshot.states_data, snapshot.sus_df, snapshot.version
+
+# Read-only JSON API served next to the dashboard, at /api/v1
+app.server.register_blueprint(api.create_api_blueprint(get_api_data))
+
+@app.server.route('/stats')
+def stats():
+    # Region residency, hit rate, figure cache size and bundle hit rate, for monitoring
+    stats = store.get_stats()
+    bundle = get_bundle(store.snapshot)
+    if bundle is not None:
+        stats['bundle'] = bundle.get_stats()
+    return flask.jsonify(stats)
+
 @app.callback(
     Output("modal", "is_open"),
     [Input("learn_more", "n_clicks"), Input("close", "n_clicks")],
@@ -209,42 +289,22 @@ def toggle_modal(n1, n2, is_open):
 
 @app.callback(
     dash.dependencies.Output('crossfilter_map_with_slider', 'figure'),
-    [dash.dependencies.Input('si_slider', 'value')]
+    [dash.dependencies.Input('si_slider', 'value'),
+     dash.dependencies.Input('map_layer_radio_item', 'value'),
+     dash.dependencies.Input('window_slider', 'value')]
     )
 
-def update_figure(selected_si):
-
-    if selected_si == 0:
-        selected_si = '0.0'
-    elif selected_si == 1:
-        selected_si = '1.0'
-
-    column = 'SI_'+ str(selected_si)
-
-    trace = go.Choropleth(
-        locations=sus_df['code'],
-        z=sus_df[column].astype(float),
-        locationmode='USA-states',
-        colorscale='Greens',
-        autocolorscale=False,
-        # hovertext=sus_df['text'], # hover text
-        marker_line_color='white', # line markers between states
-        colorbar={"thickness": 10,"len": 0.55,"x": 0.9,"y": 0.55,'outlinecolor':'white',
-                  'title': {#"text": 'SI',
-                            "side": "top"}}
-        )
+def update_figure(selected_si, map_layer='si', window=default_window):
+    snapshot = store.snapshot
 
-    return {"data": [trace],
-            "layout": go.Layout(title={'text':'Sustainability Indexes of U.S. States',
-                                        'y':0.9,
-                                        },
-                                height=350,
-                                geo = dict(
-                                    scope='usa',
-                                    projection=go.layout.geo.Projection(type = 'albers usa'),
-                                    showlakes=False, # lakes
-                                    ),
-                                margin={'t':10,'b':0,'l':10,'r':10})}
+    # Too short to score; keep showing the current map rather than different data
+    if map_layer == 'si' and window[1] - window[0] + 1 < scoring.MIN_WINDOW_YEARS:
+        raise dash.exceptions.PreventUpdate
+
+    # The slider may send 1 or 1.0; both are the same map
+    key = ('map', round(float(selected_si), 1), map_layer, tuple(window))
+
+    return get_figure(snapshot, None, key, lambda: figures.build_map(snapshot, selected_si, map_layer, window))
 
 @app.callback(Output('updatemode-output-container', 'children'),
               [Input('si_slider', 'value')])
@@ -268,83 +328,15 @@ def create_timeseries(hoverData, case, title, sources, state):
     else:
         state_code = hoverData['points'][0]['location']
 
-
-
-
-
-    line_colors = {'Nonrenewable Sources' : 'rgb(255,128,0)',
-                     'Renewable Sources' : 'rgb(0,168,84)'}
-
-    trace = []
-
+    # Case 1 follows the map, the others follow the dropdown
     if case == 1:
-        height = 350
         state = state_abbrevs_dict[state_code]
-        xaxis_range = [1960,2017]
-        for source in sources:
-
-            trace.append(go.Scatter(
-                                    x=states_data[state]['Total All Sectors'].index.year,
-                                    y=round(states_data[state]['Total All Sectors'][source]/1_000_000,2),
-                                    name=source.split()[0],
-                                    line_color=line_colors[source]
-                                    )
-                        )
-    if case == 2:
-        height = 300
-        xaxis_range=[2000, 2017]
-        for sector in sectors:
-
-            trace.append(go.Scatter(
-                                    x=states_data[state][sector].index.year,
-                                    y=round(states_data[state][sector][sources[0]]/1_000_000,2),
-                                    name=re.findall('(.*)( [Sectors]*)$',sector)[0][0]
-                                    )
-                        )
-    elif case == 3:
-        height = 300
-        xaxis_range=[2000, 2017]
-        if sources[0] == 'Renewable Sources':
-            energy_types = ['Renewable Sources'] + helper_functions.renewable_sources
-            # energy_types.append('Renewable Sources')
-        elif sources[0] == 'Nonrenewable Sources':
-            energy_types = ['Nonrenewable Sources'] + helper_functions.nonrenewable_sources
-            # energy_types.append('Nonrenewable Sources')
-
-        for energy_type in energy_types:
-            if energy_type == 'Renewable Sources':
-                name = 'All Renewable'
-            elif energy_type == 'Nonrenewable Sources':
-                name = 'All Nonrenewable'
-            else:
-                name = re.findall('(\w* ?\w*)',energy_type)[0]
-
-            trace.append(go.Scatter(
-                                    x=states_data[state]['Total All Sectors'].index.year,
-                                    y=round(states_data[state]['Total All Sectors'][energy_type]/1_000_000,2),
-                                    name=name
-                                    )
-                        )
 
-    title = state + ' ' + title
-
-    layout = go.Layout(dict(
-                        title = title,
-                        template = "plotly_white",
-                        margin={'t':70,'l':60,'b':40},
-                        xaxis_title = 'Year',
-                        yaxis_title = 'Energy Consumption (10<sup>15</sup> Btu)',
-                        xaxis_showgrid=False,
-                        yaxis_ticks='outside',
-                        yaxis_tickcolor='white',
-                        yaxis_ticklen=10,
-                        yaxis_zeroline=True,
-                        # legend={'orientation':'h',},
-                        xaxis_range=xaxis_range,
-                        height = height,  #600
-                        ))
-
-    return {'data':trace,'layout':layout}
+    snapshot = store.snapshot
+
+    return get_figure(snapshot, state, (case, title, tuple(sources)),
+                      lambda: figures.build_timeseries(snapshot.states_data, snapshot.forecast_cube,
+                                                       case, title, sources, state, snapshot.weather_models))
 
 @app.callback(
     dash.dependencies.Output('total_all_sec_ts', 'figure'),
@@ -362,10 +354,28 @@ def update_total_all_sec_ts(hoverData):
               [Input('state_dropdown', 'value')])
 
 def display_gs(value):
+    sus_df = store.snapshot.sus_df
     gs = sus_df.loc[value]['Green Score']
     es = sus_df.loc[value]['Effort Score']
     return f'Green Score {gs} | Effort Score: {es}'
 
+@app.callback(Output('similar_states', 'children'),
+              [Input('state_dropdown', 'value')])
+
+def display_similar_states(state):
+    # States whose renewable and nonrenewable trajectories look most like this one's
+    similar = store.snapshot.similarity_index.get_similar(state, k=3)
+    return 'Most similar trajectories: ' + ', '.join(f'{other} ({similarity:.2f})' for other, similarity in similar)
+
+@app.callback(Output('score_trajectory', 'figure'),
+              [Input('state_dropdown', 'value')])
+
+def update_score_trajectory(state):
+    snapshot = store.snapshot
+
+    return get_figure(snapshot, state, ('score_trajectory',),
+                      lambda: figures.build_score_trajectory(snapshot.score_history, state))
+
 @app.callback(
     dash.dependencies.Output('sectors_ts', 'figure'),
     [dash.dependencies.Input('crossfilter_map_with_slider', 'hoverData'),
@@ -0,0 +1,145 @@
+"""
+Benchmarks the decade bucket layout against the per-series documents for
+the two kinds of query the helpers in helper_functions answer:
+
+    cross-section: one fuel for every state over a range of years
+    state range:   every fuel for one state over a range of years
+
+Needs MongoDB running with both collections populated (run pipeline.py, or
+helper_functions.build_bucket_collection() on an existing database).
+
+Usage:
+
+    python bench_layouts.py --start 2005 --end 2017 --repeat 20
+"""
+
+import argparse
+import time
+
+import bson
+import numpy as np
+import pandas as pd
+
+import helper_functions
+
+
+class CountingCollection:
+    """
+    Wraps a collection and counts the BSON size of every document its find()
+    returns, so the bucket queries can be measured without fetching twice.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.bytes_fetched = 0
+
+    def find(self, *args, **kwargs):
+        for document in self.collection.find(*args, **kwargs):
+            self.bytes_fetched += len(bson.encode(document))
+            yield document
+
+
+def cross_section_from_series(energy_type, start_year, end_year, sector='Total All Sectors'):
+    """
+    Returns
+    -------
+
+        A tuple (df, bytes_fetched) answering the cross-section query the current
+        way: fetch every full series document and slice in pandas.
+    """
+    documents = list(helper_functions.energy_collection.find({'energy_type': energy_type, 'sector': sector}))
+    bytes_fetched = sum(len(bson.encode(document)) for document in documents)
+
+    # Same descending 2017-1960 index as get_energy_pop_df()
+    index = pd.to_datetime([str(year) for year in range(2017, 1959, -1)])
+    df = pd.DataFrame({document['state']: helper_functions.get_series_values(document) for document in documents},
+                      index=index)
+
+    return df.sort_index()[str(start_year):str(end_year)], bytes_fetched
+
+
+def cross_section_from_buckets(energy_type, start_year, end_year, sector='Total All Sectors'):
+    """
+    Returns
+    -------
+
+        A tuple (df, bytes_fetched) answering the cross-section query from the buckets,
+        with the same single query as helper_functions.get_energy_cross_section().
+    """
+    collection = CountingCollection(helper_functions.bucket_collection)
+    df = helper_functions.get_buckets_df({'energy_type': energy_type, 'sector': sector},
+                                         start_year, end_year, 'state', collection)
+
+    return df, collection.bytes_fetched
+
+
+def state_range_from_series(state, start_year, end_year, sector='Total All Sectors'):
+    """
+    Returns
+    -------
+
+        A tuple (df, bytes_fetched) answering the state range query from the full series documents.
+    """
+    documents = list(helper_functions.energy_collection.find({'state': state, 'sector': sector}))
+    bytes_fetched = sum(len(bson.encode(document)) for document in documents)
+
+    df = helper_functions.get_energy_pop_df(documents, sector)
+
+    return df.sort_index()[str(start_year):str(end_year)], bytes_fetched
+
+
+def state_range_from_buckets(state, start_year, end_year, sector='Total All Sectors'):
+    """
+    Returns
+    -------
+
+        A tuple (df, bytes_fetched) answering the state range query from the buckets,
+        with the same single query as helper_functions.get_state_range().
+    """
+    collection = CountingCollection(helper_functions.bucket_collection)
+    df = helper_functions.get_buckets_df({'state': state, 'sector': sector},
+                                         start_year, end_year, 'energy_type', collection)
+
+    return df, collection.bytes_fetched
+
+
+def time_query(function, args, repeat):
+    """
+    Returns
+    -------
+
+        A tuple (median seconds, bytes fetched) over repeat runs of function(*args).
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _, bytes_fetched = function(*args)
+        timings.append(time.perf_counter() - start)
+
+    return np.median(timings), bytes_fetched
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-series and decade bucket layouts.')
+    parser.add_argument('--energy-type', default='Coal')
+    parser.add_argument('--state', default='New York')
+    parser.add_argument('--start', type=int, default=2005)
+    parser.add_argument('--end', type=int, default=2017)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    benchmarks = [
+        ('cross-section', 'series', cross_section_from_series, (args.energy_type, args.start, args.end)),
+        ('cross-section', 'buckets', cross_section_from_buckets, (args.energy_type, args.start, args.end)),
+        ('state range', 'series', state_range_from_series, (args.state, args.start, args.end)),
+        ('state range', 'buckets', state_range_from_buckets, (args.state, args.start, args.end)),
+    ]
+
+    print(f'{"query":<15}{"layout":<10}{"median ms":>12}{"bytes":>12}')
+    for query, layout, function, function_args in benchmarks:
+        seconds, bytes_fetched = time_query(function, function_args, args.repeat)
+        print(f'{query:<15}{layout:<10}{seconds * 1000:>12.2f}{bytes_fetched:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import caching
+import scoring
+
+
+"""
+BOOTSTRAP CONFIDENCE INTERVALS
+------------------------------
+
+    The effort and green scores are point estimates from ~18 yearly points.
+    To get a sense of how much a state's ranking could move, the years are
+    resampled with replacement and every score is recomputed:
+
+        Effort score: the (year, integral) pairs are resampled and the slope refit.
+        Green score:  the yearly REC/NEC ratios are resampled and averaged.
+
+    Each replicate is then scaled and combined into sustainability indexes
+    exactly like get_sustainability_df(), so the intervals are on the same
+    scale as the numbers on the map.
+
+    All replicates of a chunk are computed at once as (states x replicates x
+    years) arrays. Chunks get their own seeds spawned from one master seed,
+    so results are identical no matter how many processes are used.
+"""
+
+CACHE_NAME = 'bootstrap'
+
+si_weights = np.round(np.arange(0, 1.1, 0.1), 1)
+
+
+def get_window_arrays(prefix_sums, start=2000, end=2017):
+    """
+    Returns
+    -------
+
+        A tuple (x, integrals, ratios) for the window:
+
+            x: (years - 1) array of integral years
+            integrals: (states x years - 1) array of yearly integrals of (NEC - REC)
+            ratios: (states x years) array of REC/NEC
+
+    Parameters
+    -----------
+
+        prefix_sums: [dict] Output of scoring.get_score_prefix_sums()
+
+        start: [int] First year of the window
+
+        end: [int] Last year of the window
+    """
+    years = prefix_sums['years']
+    in_window = (years >= start) & (years <= end)
+
+    rec = prefix_sums['rec'][:, in_window]
+    nec = prefix_sums['nec'][:, in_window]
+    diff = nec - rec
+
+    integrals = (diff[:, :-1] + diff[:, 1:]) / 2
+    x = years[in_window][1:].astype(float)
+
+    return x, integrals, rec / nec
+
+
+def min_max_scale(values):
+    """
+    Returns
+    -------
+
+        values min-max scaled along the first (states) axis, like MinMaxScaler does per column.
+
+    Parameters
+    -----------
+
+        values: [np.array] (states x ...) array
+    """
+    low = np.nanmin(values, axis=0)
+    high = np.nanmax(values, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (values - low) / (high - low)
+
+
+def resample_scores(x, integrals, ratios, n_resamples, seed):
+    """
+    Returns
+    -------
+
+        A (states x replicates x scores) array of scaled scores. The last axis holds the
+        Effort Score, the Green Score and then SI_0.0 through SI_1.0.
+
+    Parameters
+    -----------
+
+        x: [np.array] Integral years, from get_window_arrays()
+
+        integrals: [np.array] (states x years - 1) integrals, from get_window_arrays()
+
+        ratios: [np.array] (states x years) REC/NEC ratios, from get_window_arrays()
+
+        n_resamples: [int] Number of bootstrap replicates
+
+        seed: [int or np.random.SeedSequence] Seed for this batch of replicates
+    """
+    rng = np.random.default_rng(seed)
+
+    """
+    EFFORT SCORE
+    ------------
+    """
+    idx = rng.integers(0, len(x), size=(n_resamples, len(x)))
+    x_b = x[idx]                       # replicates x years
+    y_b = integrals[:, idx]            # states x replicates x years
+
+    x_centered = x_b - x_b.mean(axis=1, keepdims=True)
+    sxx = (x_centered ** 2).sum(axis=1)
+    sxy = (y_b * x_centered).sum(axis=2)
+
+    # A replicate that drew the same year every time has no slope
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effort = np.round(-1 * sxy / sxx, 3)
+
+    """
+    GREEN SCORE
+    -----------
+    """
+    idx = rng.integers(0, ratios.shape[1], size=(n_resamples, ratios.shape[1]))
+    green = np.round(ratios[:, idx].mean(axis=2), 3)
+
+    """
+    SCALE AND COMBINE
+    -----------------
+    """
+    es_scaled = np.round(min_max_scale(effort), 3)
+    gs_scaled = np.round(min_max_scale(green), 3)
+
+    scores = [es_scaled, gs_scaled]
+    for weight in si_weights:
+        si = ((weight * es_scaled) + (round(1 - weight, 1) * gs_scaled)) / 2
+        scores.append(np.round(min_max_scale(si), 3))
+
+    return np.stack(scores, axis=2)
+
+
+def _resample_scores_chunk(args):
+    """
+    Unpacks a tuple of arguments for resample_scores() so it can be mapped over a process pool.
+    """
+    return resample_scores(*args)
+
+
+def get_bootstrap_intervals(prefix_sums, n_resamples=2000, seed=301, alpha=0.05,
+                            start=2000, end=2017, n_jobs=1, chunk_size=500):
+    """
+    Returns
+    -------
+
+        A df indexed by state with a lower and upper bound for every score column of
+        get_sustainability_df(), e.g. 'Effort Score Lower', 'Effort Score Upper',
+        'SI_0.5 Lower', ...
+
+    Parameters
+    -----------
+
+        prefix_sums: [dict] Output of scoring.get_score_prefix_sums()
+
+        n_resamples: [int] Number of bootstrap replicates
+
+        seed: [int] Master seed. The same seed always gives the same intervals.
+
+        alpha: [float] 1 - confidence level of the intervals
+
+        start: [int] First year of the window
+
+        end: [int] Last year of the window
+
+        n_jobs: [int] Number of processes to spread the chunks over
+
+        chunk_size: [int] Number of replicates computed at once
+    """
+    x, integrals, ratios = get_window_arrays(prefix_sums, start, end)
+
+    # One child seed per chunk, so the result depends on chunk_size but not on n_jobs
+    chunk_sizes = [min(chunk_size, n_resamples - i) for i in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    chunks = [(x, integrals, ratios, size, chunk_seed) for size, chunk_seed in zip(chunk_sizes, seeds)]
+
+    if n_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_resample_scores_chunk, chunks))
+    else:
+        results = [_resample_scores_chunk(chunk) for chunk in chunks]
+
+    scores = np.concatenate(results, axis=1)
+
+    lower = np.nanpercentile(scores, 100 * alpha / 2, axis=1)
+    upper = np.nanpercentile(scores, 100 * (1 - alpha / 2), axis=1)
+
+    columns = ['Effort Score', 'Green Score'] + [f'SI_{weight}' for weight in si_weights]
+
+    data = {}
+    for i, column in enumerate(columns):
+        data[column + ' Lower'] = np.round(lower[:, i], 3)
+        data[column + ' Upper'] = np.round(upper[:, i], 3)
+
+    return pd.DataFrame(data, index=prefix_sums['states'])
+
+
+def get_cached_bootstrap_intervals(state_dfs, prefix_sums=None, cache_dir=caching.CACHE_DIR, **kwargs):
+    """
+    Returns
+    -------
+
+        The output of get_bootstrap_intervals(), loaded from the cache if it was already
+        computed for this dataset version and these arguments.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+
+        prefix_sums: [dict] Output of scoring.get_score_prefix_sums(), if already computed
+
+        cache_dir: [str] Directory the cache lives in
+
+        **kwargs: Passed on to get_bootstrap_intervals()
+    """
+    version = caching.get_dataset_version(state_dfs)
+
+    # n_jobs doesn't change the result, so it isn't part of the key
+    params = {key: value for key, value in kwargs.items() if key != 'n_jobs'}
+
+    cached = caching.load_cache(CACHE_NAME, cache_dir)
+    if cached is not None and cached['version'] == version and cached['params'] == params:
+        return cached['intervals']
+
+    if prefix_sums is None:
+        prefix_sums = scoring.get_score_prefix_sums(state_dfs)
+
+    intervals = get_bootstrap_intervals(prefix_sums, **kwargs)
+
+    caching.save_cache(CACHE_NAME, {'version': version, 'params': params, 'intervals': intervals}, cache_dir)
+
+    return intervals
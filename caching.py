@@ -0,0 +1,162 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+import pandas as pd
+
+
+"""
+LOCAL CACHE
+-----------
+
+    Precomputed results (cluster assignments, score tables, ...) are pickled
+    to a local cache directory so that the dash app and the notebooks don't
+    have to recompute them every time they start up. Each cache entry is
+    stored together with the fingerprints of the data it was computed from,
+    which lets callers tell exactly which regions have changed since then.
+"""
+
+CACHE_DIR = 'cleaned_data/cache'
+
+
+def get_region_fingerprint(region_dfs):
+    """
+    Returns
+    -------
+
+        A hex digest that changes whenever any of the region's dataframes change.
+
+    Parameters
+    -----------
+
+        region_dfs: [dict] {sector: dataframe} for a single state (or county)
+    """
+    digest = hashlib.sha1()
+
+    # Sort sectors so the fingerprint doesn't depend on dict ordering
+    for sector in sorted(region_dfs):
+        df = region_dfs[sector]
+        digest.update(sector.encode())
+        digest.update('|'.join(map(str, df.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+
+    return digest.hexdigest()
+
+
+def get_region_fingerprints(state_dfs):
+    """
+    Returns
+    -------
+
+        A dict of the form {region: fingerprint} for every region in state_dfs.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+    """
+    # Lazy stores (see region_store.py) keep fingerprints in their index, so no region has to be loaded
+    if hasattr(state_dfs, 'fingerprints'):
+        return dict(state_dfs.fingerprints)
+
+    return {region: get_region_fingerprint(state_dfs[region]) for region in state_dfs}
+
+
+def get_dataset_version(state_dfs=None, fingerprints=None):
+    """
+    Returns
+    -------
+
+        A single hex digest identifying the whole dataset.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+
+        fingerprints: [dict] Precomputed output of get_region_fingerprints(), if available
+    """
+    if fingerprints is None:
+        fingerprints = get_region_fingerprints(state_dfs)
+
+    digest = hashlib.sha1()
+    for region in sorted(fingerprints):
+        digest.update(region.encode())
+        digest.update(fingerprints[region].encode())
+
+    return digest.hexdigest()
+
+
+def get_changed_regions(old_fingerprints, new_fingerprints):
+    """
+    Returns
+    -------
+
+        A set of regions that were added, removed or modified between the two sets of fingerprints.
+
+    Parameters
+    -----------
+
+        old_fingerprints: [dict] {region: fingerprint} the cached result was computed from
+
+        new_fingerprints: [dict] {region: fingerprint} of the current data
+    """
+    regions = set(old_fingerprints) | set(new_fingerprints)
+
+    return {region for region in regions
+            if old_fingerprints.get(region) != new_fingerprints.get(region)}
+
+
+def load_cache(name, cache_dir=CACHE_DIR):
+    """
+    Returns
+    -------
+
+        The object stored under name, or None if nothing has been cached yet.
+
+    Parameters
+    -----------
+
+        name: [str] Name of the cache entry, e.g. 'clusters'
+
+        cache_dir: [str] Directory the cache lives in
+    """
+    path = os.path.join(cache_dir, name + '.pickle')
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_cache(name, obj, cache_dir=CACHE_DIR):
+    """
+    Pickles obj under name. The file is written to a temporary file of its
+    own first and then renamed, so readers never see a half-written cache
+    entry and processes saving the same entry at once don't clobber each
+    other's temporary files (the last rename wins).
+
+    Parameters
+    -----------
+
+        name: [str] Name of the cache entry, e.g. 'clusters'
+
+        obj: [object] Anything picklable
+
+        cache_dir: [str] Directory the cache lives in
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    path = os.path.join(cache_dir, name + '.pickle')
+
+    # In the same directory, so the rename stays on one filesystem
+    fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+
+from sklearn.cluster import MiniBatchKMeans
+
+import caching
+import helper_functions
+
+
+"""
+CONSUMPTION PROFILE CLUSTERING
+------------------------------
+
+    Groups regions (states now, counties later) by how they consume energy:
+    the share of each fuel in their total consumption and the share of each
+    sector, year by year. Shares are scale free, so a small state and a large
+    state with the same mix end up in the same cluster.
+
+    MiniBatchKMeans is used instead of KMeans so that fitting scales to
+    thousands of regions, and so that the model can be updated with
+    partial_fit when only a handful of regions change.
+"""
+
+# Sectors that partition 'Total All Sectors'. 'Total End-Use Sectors' is left out since it overlaps with these.
+profile_sectors = [
+    'Commercial Sector',
+    'Electric Power Sector',
+    'Industrial Sector',
+    'Residential Sector',
+    'Transportation Sector'
+]
+
+profile_fuels = helper_functions.renewable_sources + helper_functions.nonrenewable_sources
+
+N_CLUSTERS = 5
+
+CACHE_NAME = 'clusters'
+
+
+def get_profile_features(region_dfs):
+    """
+    Returns
+    -------
+
+        A 1D array with the yearly fuel-mix shares followed by the yearly sector shares of a region.
+
+    Parameters
+    -----------
+
+        region_dfs: [dict] {sector: dataframe} for a single region
+    """
+    total_df = region_dfs['Total All Sectors'].sort_index()
+
+    # Total consumption per year. Guard against years with no reported consumption at all.
+    total = (total_df['Renewable Sources'] + total_df['Nonrenewable Sources']).values.astype(float)
+    total[total == 0] = np.nan
+
+    # Fuels that a region doesn't report are simply 0% of its mix
+    fuels = total_df.reindex(columns=profile_fuels).fillna(0).values.astype(float)
+    fuel_shares = fuels / total[:, None]
+
+    sector_shares = []
+    for sector in profile_sectors:
+        if sector in region_dfs:
+            sector_df = region_dfs[sector].reindex(total_df.index)
+            sector_total = (sector_df['Renewable Sources'] + sector_df['Nonrenewable Sources']).values
+        else:
+            sector_total = np.zeros(len(total))
+        sector_shares.append(sector_total / total)
+
+    features = np.concatenate([fuel_shares.T.ravel(), np.ravel(sector_shares)])
+
+    return np.nan_to_num(features)
+
+
+def get_profile_feature_df(state_dfs, regions=None):
+    """
+    Returns
+    -------
+
+        A dataframe with one row of profile features per region.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+
+        regions: [iterable] Only featurize these regions. Defaults to all of them.
+    """
+    if regions is None:
+        regions = list(state_dfs)
+
+    regions = list(regions)
+    matrix = [get_profile_features(state_dfs[region]) for region in regions]
+
+    return pd.DataFrame(matrix, index=regions)
+
+
+def fit_clusters(features, n_clusters=N_CLUSTERS, random_state=10):
+    """
+    Returns
+    -------
+
+        A MiniBatchKMeans model fit on the given features.
+
+    Parameters
+    -----------
+
+        features: [pd.DataFrame] Output of get_profile_feature_df()
+
+        n_clusters: [int] Number of clusters
+
+        random_state: [int] Seed, so the same data always gives the same clusters
+    """
+    model = MiniBatchKMeans(n_clusters=n_clusters,
+                            random_state=random_state,
+                            batch_size=1024,
+                            n_init=3)
+
+    return model.fit(features.values)
+
+
+def get_cluster_labels(state_dfs, changed_regions=None, n_clusters=N_CLUSTERS, cache_dir=caching.CACHE_DIR):
+    """
+    Returns
+    -------
+
+        A pd.Series mapping every region to its cluster label.
+
+        Labels are cached along with the data fingerprints they were computed
+        from. On later calls nothing is refit unless some regions have changed,
+        in which case only their features are recomputed and the model is
+        updated with partial_fit before relabeling.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+
+        changed_regions: [iterable] Regions the ETL reports as changed. If None, changes are
+                         detected by comparing fingerprints with the cached ones.
+
+        n_clusters: [int] Number of clusters
+
+        cache_dir: [str] Directory the cache lives in
+    """
+    fingerprints = caching.get_region_fingerprints(state_dfs)
+    cached = caching.load_cache(CACHE_NAME, cache_dir)
+
+    # Nothing usable cached, so fit from scratch
+    if cached is None or cached['n_clusters'] != n_clusters:
+        features = get_profile_feature_df(state_dfs)
+        model = fit_clusters(features, n_clusters)
+
+    else:
+        if changed_regions is None:
+            changed_regions = caching.get_changed_regions(cached['fingerprints'], fingerprints)
+
+        # Nothing changed since the last run, so just hand back the cached labels
+        if not changed_regions:
+            return cached['labels']
+
+        features = cached['features'].drop(index=[region for region in changed_regions
+                                                   if region in cached['features'].index])
+        updated = [region for region in changed_regions if region in state_dfs]
+        model = cached['model']
+
+        if updated:
+            updated_features = get_profile_feature_df(state_dfs, updated)
+
+            # A change in the number of years means the old model no longer applies
+            if updated_features.shape[1] != features.shape[1]:
+                features = get_profile_feature_df(state_dfs)
+                model = fit_clusters(features, n_clusters)
+            else:
+                features = pd.concat([features, updated_features])
+                model.partial_fit(updated_features.values)
+
+        features = features.loc[[region for region in state_dfs]]
+
+    labels = pd.Series(model.predict(features.values), index=features.index, name='Cluster')
+
+    caching.save_cache(CACHE_NAME,
+                       {'fingerprints': fingerprints,
+                        'features': features,
+                        'model': model,
+                        'labels': labels,
+                        'n_clusters': n_clusters},
+                       cache_dir)
+
+    return labels
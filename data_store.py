@@ -0,0 +1,332 @@
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import analysis_session
+import bootstrap
+import caching
+import clustering
+import forecasting
+import helper_functions
+import region_store
+import scoring
+import similarity
+import weather
+
+
+"""
+HOT RELOADABLE DATA
+-------------------
+
+    Everything the dash app serves is derived from the state dataframes.
+    It is bundled into one immutable Snapshot, and the app reads
+    store.snapshot once at the start of each callback.
+
+    A reload builds a complete new Snapshot in a background thread and then
+    replaces store.snapshot with a single assignment. Callbacks that are
+    already running keep the snapshot they started with, and new callbacks
+    see the new one; nothing blocks and nobody sees a half-built state.
+
+    Cached figures are keyed on the fingerprint of the state they show (or
+    on the dataset version for figures that depend on every state), so after
+    a swap only the figures of states whose data changed are rebuilt.
+"""
+
+Snapshot = namedtuple('Snapshot', ['states_data',
+                                   'sus_df',
+                                   'score_prefix_sums',
+                                   'score_history',
+                                   'score_intervals',
+                                   'forecast_cube',
+                                   'weather_models',
+                                   'similarity_index',
+                                   'fingerprints',
+                                   'version'])
+
+
+def build_snapshot(states_data, sus_df=None, previous=None):
+    """
+    Returns
+    -------
+
+        A Snapshot with every table the dash app needs, computed from states_data.
+
+    Parameters
+    -----------
+
+        states_data: [dict] {state: {sector: dataframe}}
+
+        sus_df: [DataFrame] Output of helper_functions.get_sustainability_df() for states_data,
+                if already available (e.g. from an analysis session). Computed if not given.
+
+        previous: [Snapshot] The snapshot being replaced, if any. When the new data only adds
+                  years, its score prefix sums and history are extended instead of recomputed.
+    """
+    fingerprints = caching.get_region_fingerprints(states_data)
+
+    if sus_df is None:
+        sus_df = helper_functions.get_sustainability_df(helper_functions.get_sustainability_indicators(states_data))
+
+    # Precomputed consumption profile clusters for the map's cluster layer
+    sus_df['Cluster'] = clustering.get_cluster_labels(states_data)
+
+    # Prefix sums let the map rescore any window of years without rerunning the regressions.
+    # The score history has the trailing-window score of every state and year, for the score trajectory chart.
+    if previous is None:
+        score_prefix_sums = scoring.get_score_prefix_sums(states_data)
+        score_history = scoring.get_score_history(score_prefix_sums)
+    else:
+        score_prefix_sums, score_history = scoring.update_score_history(previous.score_prefix_sums,
+                                                                        previous.score_history, states_data)
+
+    return Snapshot(states_data=states_data,
+                    sus_df=sus_df,
+                    score_prefix_sums=score_prefix_sums,
+                    score_history=score_history,
+                    # Bootstrap confidence intervals for the default window, shown when hovering over the map
+                    score_intervals=bootstrap.get_cached_bootstrap_intervals(states_data, score_prefix_sums)
+                                             .reindex(sus_df.index),
+                    # Trend projections for every series, overlaid on the time series plots
+                    forecast_cube=forecasting.get_forecast_cube(states_data),
+                    # Weather sensitivity models, None if there is no temperature data
+                    weather_models=weather.get_cached_weather_models(states_data),
+                    # Nearest neighbour index over consumption trajectories, for the similar states list
+                    similarity_index=similarity.get_similarity_index(states_data),
+                    fingerprints=fingerprints,
+                    version=caching.get_dataset_version(fingerprints=fingerprints))
+
+
+class FigureCache:
+    """
+    Thread-safe, bounded LRU cache of built figures.
+
+    Entries are grouped by region so that all of a region's figures can be
+    dropped at once. Region None holds figures that depend on every region.
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_or_build(self, region, version, key, build):
+        """
+        Returns
+        -------
+
+            The cached figure for (region, version, key), building and caching it if needed.
+
+        Parameters
+        -----------
+
+            region: [str] Region the figure shows, or None if it depends on every region
+
+            version: [str] Fingerprint of the region's data (or the dataset version for region None)
+
+            key: [tuple] Anything else the figure depends on, e.g. the callback arguments
+
+            build: [callable] Builds the figure when it isn't cached
+        """
+        cache_key = (region, version, key)
+
+        with self.lock:
+            if cache_key in self.entries:
+                self.entries.move_to_end(cache_key)
+                return self.entries[cache_key]
+
+        # Built outside the lock so slow figures don't hold up other callbacks
+        figure = build()
+
+        with self.lock:
+            self.entries[cache_key] = figure
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return figure
+
+    def invalidate(self, regions):
+        """
+        Drops every cached figure of the given regions.
+
+        Parameters
+        -----------
+
+            regions: [iterable] Regions to drop. Include None to drop figures that depend on every region.
+        """
+        regions = set(regions)
+
+        with self.lock:
+            for cache_key in [cache_key for cache_key in self.entries if cache_key[0] in regions]:
+                del self.entries[cache_key]
+
+
+class DataStore:
+    """
+    Holds the current Snapshot and swaps in a new one when the data changes.
+
+    The data can come from:
+
+        'pickle':  the state dataframes pickle, loaded whole
+        'regions': a region store (see region_store.py), loaded lazily one region
+                   at a time. If pickle_path is given the store is rebuilt from
+                   the pickle whenever the pickle is newer.
+        'mongo':   MongoDB, reloaded when the version stamp written by the ETL changes
+    """
+
+    def __init__(self, pickle_path='cleaned_data/state_dfs.pickle', source='pickle', store_dir=None,
+                 max_region_bytes=256 * 1024 ** 2, figure_cache_entries=2048):
+        """
+        Parameters
+        -----------
+
+            pickle_path: [str] Path to the pickled state dataframes
+
+            source: [str] 'pickle', 'regions' or 'mongo'
+
+            store_dir: [str] Directory of the region store, for source 'regions'
+
+            max_region_bytes: [int] Memory budget of the region store
+
+            figure_cache_entries: [int] Maximum number of cached figures
+        """
+        assert source in ['pickle', 'regions', 'mongo'], "source must be 'pickle', 'regions' or 'mongo'"
+
+        self.pickle_path = pickle_path
+        self.source = source
+        self.store_dir = store_dir
+        self.max_region_bytes = max_region_bytes
+        self.figures = FigureCache(figure_cache_entries)
+        # Persisted with the other caches, so restarts skip the whole chain until the ETL loads new data
+        self.session = analysis_session.AnalysisSession(cache_dir=caching.CACHE_DIR) if source == 'mongo' else None
+        self.reload_lock = threading.Lock()
+        self.watcher = None
+
+        self.source_version = self.get_source_version()
+        self.snapshot = self.build_snapshot()
+
+    def get_source_version(self):
+        """
+        Returns
+        -------
+
+            A cheap token that changes whenever the underlying data changes.
+        """
+        if self.source == 'mongo':
+            return self.session.get_version()
+
+        if self.source == 'regions':
+            if self.pickle_path is not None:
+                region_store.ensure_region_store(self.pickle_path, self.store_dir)
+            stat = os.stat(os.path.join(self.store_dir, region_store.INDEX_NAME))
+            return (stat.st_mtime_ns, stat.st_size)
+
+        stat = os.stat(self.pickle_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load_states_data(self):
+        """
+        Returns
+        -------
+
+            The state dataframes from the configured source.
+        """
+        if self.source == 'mongo':
+            # The session only rebuilds the dataframes when the version stamp has changed
+            return self.session.get_states_data()
+
+        if self.source == 'regions':
+            return region_store.RegionStore(self.store_dir, self.max_region_bytes)
+
+        with open(self.pickle_path, 'rb') as f:
+            return pickle.load(f)
+
+    def build_snapshot(self, previous=None):
+        """
+        Returns
+        -------
+
+            A Snapshot of the configured source. From MongoDB the sustainability
+            table comes out of the analysis session, like the dataframes do.
+
+        Parameters
+        -----------
+
+            previous: [Snapshot] The snapshot being replaced, passed on to build_snapshot()
+        """
+        if self.source == 'mongo':
+            return build_snapshot(self.load_states_data(), self.session.get_sustainability_df(), previous)
+
+        return build_snapshot(self.load_states_data(), previous=previous)
+
+    def reload(self):
+        """
+        Returns
+        -------
+
+            The set of regions whose data changed (empty if nothing did).
+
+            Builds a new snapshot and swaps it in. The old snapshot stays in
+            use by any callback that already grabbed it. Only one reload runs
+            at a time.
+        """
+        with self.reload_lock:
+            source_version = self.get_source_version()
+            # A yearly update only appends to the score history of the current snapshot
+            new_snapshot = self.build_snapshot(previous=self.snapshot)
+
+            old_snapshot = self.snapshot
+            changed = caching.get_changed_regions(old_snapshot.fingerprints, new_snapshot.fingerprints)
+
+            # The swap: a single reference assignment
+            self.snapshot = new_snapshot
+            self.source_version = source_version
+
+            if changed:
+                # Figures that depend on every state (the map) change whenever any state does
+                self.figures.invalidate(changed | {None})
+
+            return changed
+
+    def get_stats(self):
+        """
+        Returns
+        -------
+
+            A dict with the number of cached figures and, for a region store, its
+            residency and hit-rate statistics.
+        """
+        stats = {'version': self.snapshot.version, 'cached_figures': len(self.figures.entries)}
+
+        states_data = self.snapshot.states_data
+        if hasattr(states_data, 'get_stats'):
+            stats['regions'] = states_data.get_stats()
+
+        return stats
+
+    def watch(self, interval=30):
+        """
+        Starts a daemon thread that checks the source every interval seconds
+        and reloads in the background when it changes.
+
+        Parameters
+        -----------
+
+            interval: [float] Seconds between checks
+        """
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.get_source_version() != self.source_version:
+                        changed = self.reload()
+                        print(f'Reloaded data, {len(changed)} regions changed')
+                except Exception as e:
+                    # Keep serving the current snapshot and try again next time
+                    print('OOPS!! Data reload failed')
+                    print(str(e))
+
+        if self.watcher is None:
+            self.watcher = threading.Thread(target=poll, daemon=True)
+            self.watcher.start()
@@ -0,0 +1,395 @@
+"""
+Prebuilt figure bundle for the dash app.
+
+The data only changes when the ETL runs, so almost every figure the app
+serves can be built ahead of time: the map for each of the 11 SI slider
+positions (SI and cluster layers, default score window), and every state's
+time series (consumption with trend, renewable/nonrenewable by sector and by
+fuel) and score trajectory.
+
+build_bundle() renders all of them once and writes a single gzipped JSON
+file named after its contents. Identical payloads are stored once (the
+cluster map, for instance, doesn't depend on the slider). A small pointer
+file records which bundle is current and which dataset version it was built
+from.
+
+The app looks figures up in the bundle first and only builds them live for
+combinations the bundle doesn't cover (e.g. non-default score windows), or
+when the bundle was built from a different dataset version. In that case it
+checks whether the pointer has moved on (see reload_bundle()), so a bundle
+rebuilt after a data reload is picked up without restarting the app.
+
+export_static() writes the bundle out as plain JSON files plus an HTML
+viewer, which can be served by any static file server without the app.
+
+Usage:
+
+    python figure_bundle.py --out cleaned_data/bundle [--static site]
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import plotly.io as pio
+
+import data_store
+import figures
+import region_store
+
+BUNDLE_DIR = 'cleaned_data/bundle'
+POINTER_NAME = 'bundle.json'
+
+# Positions of the SI slider in the app
+si_values = [float(si) for si in np.round(np.arange(0.0, 1.1, 0.1), 1)]
+
+
+def get_bundle_key(region, key):
+    """
+    Returns
+    -------
+
+        The string a figure is stored under in the bundle.
+
+    Parameters
+    -----------
+
+        region: [str] State the figure shows, or None for the map
+
+        key: [tuple] The same key the app caches the figure under
+    """
+    return json.dumps([region, key])
+
+
+def get_figure_specs(snapshot):
+    """
+    Returns
+    -------
+
+        A list of (region, key, build) for every figure in the bundle, where
+        build() returns the figure dict.
+
+    Parameters
+    -----------
+
+        snapshot: [data_store.Snapshot] Data the figures are built from
+    """
+    window = tuple(figures.default_window)
+    specs = []
+
+    for si in si_values:
+        for map_layer in ['si', 'cluster']:
+            specs.append((None, ('map', si, map_layer, window),
+                          lambda si=si, map_layer=map_layer: figures.build_map(snapshot, si, map_layer)))
+
+    for state in snapshot.states_data:
+        for _, case, title, sources in figures.report_timeseries:
+            specs.append((state, (case, title, tuple(sources)),
+                          lambda state=state, case=case, title=title, sources=sources:
+                              figures.build_timeseries(snapshot.states_data, snapshot.forecast_cube,
+                                                       case, title, sources, state, snapshot.weather_models)))
+
+        specs.append((state, ('score_trajectory',),
+                      lambda state=state: figures.build_score_trajectory(snapshot.score_history, state)))
+
+    return specs
+
+
+def write_file(path, data):
+    """
+    Writes data to path through a temporary file of its own in the same
+    directory, so readers never see a half-written file and two builds
+    writing the same file don't clobber each other's temporary files.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def build_bundle(snapshot, bundle_dir=BUNDLE_DIR):
+    """
+    Returns
+    -------
+
+        The pointer to the new bundle: a dict with the bundle file name, the
+        dataset version and the number of figures and distinct payloads.
+
+    Parameters
+    -----------
+
+        snapshot: [data_store.Snapshot] Data the figures are built from
+
+        bundle_dir: [str] Directory of the bundle
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+
+    index = {}
+    payloads = {}
+
+    for region, key, build in get_figure_specs(snapshot):
+        # The figures were validated when they were built
+        payload = pio.to_json(build(), validate=False)
+        digest = hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+        payloads.setdefault(digest, json.loads(payload))
+        index[get_bundle_key(region, key)] = digest
+
+    document = json.dumps({'version': snapshot.version, 'index': index, 'payloads': payloads},
+                          separators=(',', ':'))
+    data = gzip.compress(document.encode(), mtime=0)
+
+    # Named after its contents, so a bundle file never changes once written
+    bundle_name = 'figures-' + hashlib.sha1(data).hexdigest()[:16] + '.json.gz'
+    write_file(os.path.join(bundle_dir, bundle_name), data)
+
+    pointer = {'file': bundle_name,
+               'version': snapshot.version,
+               'figures': len(index),
+               'payloads': len(payloads),
+               'bytes': len(data)}
+
+    write_file(os.path.join(bundle_dir, POINTER_NAME), json.dumps(pointer).encode())
+
+    for name in os.listdir(bundle_dir):
+        if name.startswith('figures-') and name.endswith('.json.gz') and name != bundle_name:
+            os.remove(os.path.join(bundle_dir, name))
+
+    return pointer
+
+
+class FigureBundle:
+    """
+    Prebuilt figures loaded into memory, looked up by the app's figure keys.
+    """
+
+    def __init__(self, bundle_dir=BUNDLE_DIR):
+        """
+        Parameters
+        -----------
+
+            bundle_dir: [str] Directory of the bundle
+        """
+        pointer_path = os.path.join(bundle_dir, POINTER_NAME)
+        self.pointer_mtime = os.stat(pointer_path).st_mtime_ns
+
+        with open(pointer_path, 'r') as f:
+            pointer = json.load(f)
+
+        with gzip.open(os.path.join(bundle_dir, pointer['file']), 'rt') as f:
+            document = json.load(f)
+
+        self.version = document['version']
+        self.figures = {key: document['payloads'][digest] for key, digest in document['index'].items()}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version, region, key):
+        """
+        Returns
+        -------
+
+            The prebuilt figure dict, or None if the bundle doesn't have it or
+            was built from a different dataset version.
+
+        Parameters
+        -----------
+
+            version: [str] Dataset version of the data being served
+
+            region: [str] State the figure shows, or None for the map
+
+            key: [tuple] The key the app caches the figure under
+        """
+        figure = None
+        if version == self.version:
+            figure = self.figures.get(get_bundle_key(region, key))
+
+        if figure is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return figure
+
+    def get_stats(self):
+        requests = self.hits + self.misses
+        return {'version': self.version,
+                'figures': len(self.figures),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests, 4) if requests else None}
+
+
+def load_bundle(bundle_dir=BUNDLE_DIR):
+    """
+    Returns
+    -------
+
+        A FigureBundle, or None if no bundle has been built in bundle_dir.
+    """
+    if not os.path.exists(os.path.join(bundle_dir, POINTER_NAME)):
+        return None
+
+    return FigureBundle(bundle_dir)
+
+
+def reload_bundle(bundle, bundle_dir=BUNDLE_DIR):
+    """
+    Returns
+    -------
+
+        The bundle the pointer in bundle_dir currently refers to: bundle itself
+        if the pointer hasn't changed since it was loaded, otherwise the newly
+        built bundle (None if there is none).
+
+    Parameters
+    -----------
+
+        bundle: [FigureBundle] The bundle in use, or None
+
+        bundle_dir: [str] Directory of the bundle
+    """
+    pointer_path = os.path.join(bundle_dir, POINTER_NAME)
+    if not os.path.exists(pointer_path):
+        return None
+
+    if bundle is not None and os.stat(pointer_path).st_mtime_ns == bundle.pointer_mtime:
+        return bundle
+
+    return FigureBundle(bundle_dir)
+
+
+"""
+STATIC EXPORT
+-------------
+"""
+
+STATIC_VIEWER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>U.S. Energy Sustainability</title>
+<script src="https://cdn.plot.ly/plotly-2.35.2.min.js"></script>
+</head>
+<body style="font-family: sans-serif; max-width: 1000px; margin: auto">
+<p>
+  SI weight <input id="si" type="range" min="0" max="1" step="0.1" value="1">
+  Layer <select id="layer"><option value="si">Sustainability Index</option><option value="cluster">Clusters</option></select>
+  State <select id="state"></select>
+</p>
+<div id="map"></div>
+<div id="state_figures"></div>
+<script>
+fetch('index.json').then(response => response.json()).then(index => {
+  const show = (div, path) => fetch(path).then(response => response.json())
+                                         .then(figure => Plotly.react(div, figure.data, figure.layout));
+  const si = document.getElementById('si');
+  const layer = document.getElementById('layer');
+  const state = document.getElementById('state');
+  Object.keys(index.states).forEach(name => state.add(new Option(name, name)));
+
+  const show_map = () => show('map', index.maps[layer.value][si.value]);
+  const show_state = () => {
+    const container = document.getElementById('state_figures');
+    container.innerHTML = '';
+    index.states[state.value].forEach(path => {
+      const div = document.createElement('div');
+      container.appendChild(div);
+      show(div, path);
+    });
+  };
+
+  si.oninput = show_map;
+  layer.onchange = show_map;
+  state.onchange = show_state;
+  show_map();
+  show_state();
+});
+</script>
+</body>
+</html>
+"""
+
+
+def export_static(bundle_dir=BUNDLE_DIR, out_dir='site'):
+    """
+    Writes every figure in the bundle to out_dir as its own JSON file, plus
+    an index.json and an index.html viewer for the map and each state's figures.
+
+    Parameters
+    -----------
+
+        bundle_dir: [str] Directory of the bundle
+
+        out_dir: [str] Directory of the static site
+    """
+    bundle = FigureBundle(bundle_dir)
+
+    os.makedirs(os.path.join(out_dir, 'figures'), exist_ok=True)
+
+    def write_figure(figure):
+        payload = json.dumps(figure, separators=(',', ':'))
+        path = 'figures/' + hashlib.sha1(payload.encode()).hexdigest()[:16] + '.json'
+
+        if not os.path.exists(os.path.join(out_dir, path)):
+            with open(os.path.join(out_dir, path), 'w') as f:
+                f.write(payload)
+
+        return path
+
+    # The viewer looks maps up by layer and by slider value as the browser formats it ('0', '0.1', ..., '1')
+    window = tuple(figures.default_window)
+    maps = {map_layer: {f'{si:g}': write_figure(bundle.figures[get_bundle_key(None, ('map', si, map_layer, window))])
+                        for si in si_values}
+            for map_layer in ['si', 'cluster']}
+
+    states = {}
+    for key, figure in bundle.figures.items():
+        region = json.loads(key)[0]
+        if region is not None:
+            states.setdefault(region, []).append(write_figure(figure))
+
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump({'version': bundle.version,
+                   'maps': maps,
+                   'states': dict(sorted(states.items()))}, f)
+
+    with open(os.path.join(out_dir, 'index.html'), 'w') as f:
+        f.write(STATIC_VIEWER)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prebuild every figure the dash app serves.')
+    parser.add_argument('--pickle', default='cleaned_data/state_dfs.pickle')
+    parser.add_argument('--regions', help='Read states lazily from this region store instead of the pickle.')
+    parser.add_argument('--out', default=BUNDLE_DIR)
+    parser.add_argument('--static', help='Also export the bundle as a static site to this directory.')
+    args = parser.parse_args()
+
+    if args.regions:
+        states_data = region_store.RegionStore(args.regions)
+    else:
+        with open(args.pickle, 'rb') as f:
+            states_data = pickle.load(f)
+
+    pointer = build_bundle(data_store.build_snapshot(states_data), args.out)
+    print(f'{pointer["figures"]} figures ({pointer["payloads"]} distinct, {pointer["bytes"] / 1024:.0f} KiB) '
+          f'in {pointer["file"]}')
+
+    if args.static:
+        export_static(args.out, args.static)
+
+
+if __name__ == '__main__':
+    main()
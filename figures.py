@@ -0,0 +1,298 @@
+import re
+
+import plotly.graph_objs as go
+
+import forecasting
+import helper_functions
+import scoring
+import weather
+
+
+"""
+FIGURES
+-------
+
+    The map, time series and score trajectory figures shown in the dash app.
+    They only depend on the data passed in, so the app and the batch report
+    export (see reports.py) build exactly the same figures.
+"""
+
+# Score window the sustainability index table (and its confidence intervals) is computed for
+default_window = [2000, 2017]
+
+line_colors = {'Nonrenewable Sources' : 'rgb(255,128,0)',
+               'Renewable Sources' : 'rgb(0,168,84)'}
+
+# The time series in a state's report, as (name, case, title, sources)
+report_timeseries = [
+    ('energy_consumption', 1, 'Energy Consumption', ['Nonrenewable Sources', 'Renewable Sources']),
+    ('renewable_by_sector', 2, 'Renewable Energy Consumption by Sector', ['Renewable Sources']),
+    ('nonrenewable_by_sector', 2, 'Nonrenewable Energy Consumption by Sector', ['Nonrenewable Sources']),
+    ('renewable_by_fuel', 3, 'Renewable Energy Consumption for All Sectors by Fuel', ['Renewable Sources']),
+    ('nonrenewable_by_fuel', 3, 'Nonrenewable Energy Consumption for All Sectors by Fuel', ['Nonrenewable Sources'])
+]
+
+
+def build_map(snapshot, selected_si, map_layer='si', window=default_window):
+    """
+    Returns
+    -------
+
+        A plotly figure dict with the choropleth map of the sustainability indexes
+        (or of the consumption profile clusters).
+
+    Parameters
+    -----------
+
+        snapshot: [data_store.Snapshot] Uses score_prefix_sums and score_intervals (sus_df for the cluster layer)
+
+        selected_si: [float] Weight of the effort score, 0.0 to 1.0 in steps of 0.1
+
+        map_layer: [str] 'si' or 'cluster'
+
+        window: [list] [first year, last year] the scores are computed for, at least
+                scoring.MIN_WINDOW_YEARS long
+    """
+    sus_df = snapshot.sus_df
+
+    if selected_si == 0:
+        selected_si = '0.0'
+    elif selected_si == 1:
+        selected_si = '1.0'
+
+    column = 'SI_'+ str(selected_si)
+
+    if map_layer == 'cluster':
+        title = 'Consumption Profile Clusters of U.S. States'
+        trace = go.Choropleth(
+            locations=sus_df['code'],
+            z=sus_df['Cluster'],
+            locationmode='USA-states',
+            colorscale='Viridis',
+            autocolorscale=False,
+            hovertext=['Cluster ' + str(label) for label in sus_df['Cluster']],
+            marker_line_color='white', # line markers between states
+            showscale=False
+            )
+    else:
+        # Every window, the default one included, is scored by the prefix sum engine, so moving
+        # the slider never switches between differently computed tables. Raises ValueError for
+        # windows shorter than scoring.MIN_WINDOW_YEARS.
+        window_df = scoring.get_window_sustainability_df(snapshot.score_prefix_sums, window[0], window[1])
+
+        # The bootstrap intervals are only computed for the default window
+        if list(window) == default_window:
+            title = 'Sustainability Indexes of U.S. States'
+            hovertext = [f'{state}<br>95% CI: {lower} - {upper}'
+                         for state, lower, upper in zip(window_df.index,
+                                                        snapshot.score_intervals[column + ' Lower']
+                                                                .reindex(window_df.index),
+                                                        snapshot.score_intervals[column + ' Upper']
+                                                                .reindex(window_df.index))]
+        else:
+            title = f'Sustainability Indexes of U.S. States ({window[0]}-{window[1]})'
+            hovertext = list(window_df.index)
+
+        trace = go.Choropleth(
+            locations=window_df['code'],
+            z=window_df[column].astype(float),
+            locationmode='USA-states',
+            colorscale='Greens',
+            autocolorscale=False,
+            hovertext=hovertext, # hover text
+            marker_line_color='white', # line markers between states
+            colorbar={"thickness": 10,"len": 0.55,"x": 0.9,"y": 0.55,'outlinecolor':'white',
+                      'title': {#"text": 'SI',
+                                "side": "top"}}
+            )
+
+    return {"data": [trace],
+            "layout": go.Layout(title={'text':title,
+                                        'y':0.9,
+                                        },
+                                height=350,
+                                geo = dict(
+                                    scope='usa',
+                                    projection=go.layout.geo.Projection(type = 'albers usa'),
+                                    showlakes=False, # lakes
+                                    ),
+                                margin={'t':10,'b':0,'l':10,'r':10})}
+
+
+def build_timeseries(states_data, forecast_cube, case, title, sources, state, weather_models=None):
+    """
+    Returns
+    -------
+
+        A plotly figure dict with the state's energy consumption over time.
+
+        There are three cases for time series plots:
+        1) Both sources (renewable & nonrenewable) for 'Total All Sectors'
+        2) One source for all sectors
+        3) All fuel types that make up one source for 'Total All Sectors' (could later expand to choosing sector)
+
+    Parameters
+    -----------
+
+        states_data: [dict] {state: {sector: dataframe}}
+
+        forecast_cube: [dict] Output of forecasting.get_forecast_cube(), for the trend overlay in case 1
+
+        case: [int] 1, 2 or 3
+
+        title: [str] Figure title, prefixed with the state name
+
+        sources: [list] 'Renewable Sources' and/or 'Nonrenewable Sources'
+
+        state: [str] e.g. 'New York'
+
+        weather_models: [dict] Output of weather.get_weather_models(), to overlay the weather model fit in case 1
+    """
+    assert case in [1, 2, 3], "Make sure to select one of 3 possible cases: 1, 2, or 3"
+
+    trace = []
+
+    if case == 1:
+        height = 350
+        xaxis_range = [1960,forecast_cube['years'][-1]]
+        for source in sources:
+
+            trace.append(go.Scatter(
+                                    x=states_data[state]['Total All Sectors'].index.year,
+                                    y=round(states_data[state]['Total All Sectors'][source]/1_000_000,2),
+                                    name=source.split()[0],
+                                    line_color=line_colors[source]
+                                    )
+                        )
+
+            # Overlay the trend projection with its prediction interval
+            forecast = forecasting.get_series_forecast(forecast_cube, state, 'Total All Sectors', source)
+            forecast = round(forecast/1_000_000,2)
+
+            trace.append(go.Scatter(
+                                    x=list(forecast.index) + list(forecast.index[::-1]),
+                                    y=list(forecast['upper']) + list(forecast['lower'][::-1]),
+                                    fill='toself',
+                                    fillcolor=line_colors[source].replace('rgb','rgba').replace(')',',0.2)'),
+                                    line_color='rgba(0,0,0,0)',
+                                    hoverinfo='skip',
+                                    showlegend=False
+                                    )
+                        )
+            trace.append(go.Scatter(
+                                    x=forecast.index,
+                                    y=forecast['mean'],
+                                    name=source.split()[0] + ' (Trend)',
+                                    line={'color':line_colors[source], 'dash':'dash'}
+                                    )
+                        )
+
+            # Overlay what the weather model explains (trend plus weather)
+            weather_fit = None
+            if weather_models is not None:
+                weather_fit = weather.get_series_weather_fit(weather_models, state, 'Total All Sectors', source)
+
+            if weather_fit is not None:
+                trace.append(go.Scatter(
+                                        x=weather_fit.index,
+                                        y=round(weather_fit/1_000_000,2),
+                                        name=source.split()[0] + ' (Weather Model)',
+                                        line={'color':line_colors[source], 'dash':'dot', 'width':1}
+                                        )
+                            )
+    if case == 2:
+        height = 300
+        xaxis_range=[2000, 2017]
+        for sector in states_data[state].keys():
+
+            trace.append(go.Scatter(
+                                    x=states_data[state][sector].index.year,
+                                    y=round(states_data[state][sector][sources[0]]/1_000_000,2),
+                                    name=re.findall('(.*)( [Sectors]*)$',sector)[0][0]
+                                    )
+                        )
+    elif case == 3:
+        height = 300
+        xaxis_range=[2000, 2017]
+        if sources[0] == 'Renewable Sources':
+            energy_types = ['Renewable Sources'] + helper_functions.renewable_sources
+            # energy_types.append('Renewable Sources')
+        elif sources[0] == 'Nonrenewable Sources':
+            energy_types = ['Nonrenewable Sources'] + helper_functions.nonrenewable_sources
+            # energy_types.append('Nonrenewable Sources')
+
+        for energy_type in energy_types:
+            if energy_type == 'Renewable Sources':
+                name = 'All Renewable'
+            elif energy_type == 'Nonrenewable Sources':
+                name = 'All Nonrenewable'
+            else:
+                name = re.findall('(\w* ?\w*)',energy_type)[0]
+
+            trace.append(go.Scatter(
+                                    x=states_data[state]['Total All Sectors'].index.year,
+                                    y=round(states_data[state]['Total All Sectors'][energy_type]/1_000_000,2),
+                                    name=name
+                                    )
+                        )
+
+    title = state + ' ' + title
+
+    layout = go.Layout(dict(
+                        title = title,
+                        template = "plotly_white",
+                        margin={'t':70,'l':60,'b':40},
+                        xaxis_title = 'Year',
+                        yaxis_title = 'Energy Consumption (10<sup>15</sup> Btu)',
+                        xaxis_showgrid=False,
+                        yaxis_ticks='outside',
+                        yaxis_tickcolor='white',
+                        yaxis_ticklen=10,
+                        yaxis_zeroline=True,
+                        # legend={'orientation':'h',},
+                        xaxis_range=xaxis_range,
+                        height = height,  #600
+                        ))
+
+    return {'data':trace,'layout':layout}
+
+
+def build_score_trajectory(score_history, state):
+    """
+    Returns
+    -------
+
+        A plotly figure dict with the state's trailing-window effort and green scores.
+
+    Parameters
+    -----------
+
+        score_history: [dict] Output of scoring.get_score_history()
+
+        state: [str] e.g. 'New York'
+    """
+    state_history = scoring.get_state_score_history(score_history, state)
+
+    trace = [go.Scatter(x=state_history.index,
+                        y=state_history['effort_score'].round(3),
+                        name='Effort',
+                        line_color='rgb(255,128,0)'),
+             go.Scatter(x=state_history.index,
+                        y=state_history['green_score'].round(3),
+                        name='Green',
+                        line_color='rgb(0,168,84)',
+                        yaxis='y2')]
+
+    layout = go.Layout(dict(
+                        title = f'Score Trajectory ({score_history["window"]}-Year Windows)',
+                        template = "plotly_white",
+                        margin={'t':50,'l':40,'r':40,'b':40},
+                        xaxis_title = 'Window End Year',
+                        xaxis_showgrid=False,
+                        yaxis_title = 'Effort',
+                        yaxis2={'title':'Green', 'overlaying':'y', 'side':'right', 'showgrid':False},
+                        legend={'orientation':'h', 'y':-0.3},
+                        height = 300,
+                        ))
+
+    return {'data':trace,'layout':layout}
@@ -0,0 +1,209 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+"""
+BATCH TREND FORECASTING
+-----------------------
+
+    Short-term consumption projections for every state x sector x fuel series.
+
+    All series share the same yearly index, so the least squares design matrix
+    is the same for every one of them. Instead of fitting one LinearRegression
+    per series, the series are stacked into a matrix and every fit is solved
+    at once with a couple of matrix products. Prediction intervals come from
+    the usual OLS formula using each series' residual variance.
+"""
+
+# Columns of the state dataframes that aren't energy series
+non_energy_columns = ['Population']
+
+# Normal quantile for a 95% prediction interval
+Z_95 = 1.96
+
+
+def get_series_cube(state_dfs):
+    """
+    Returns
+    -------
+
+        A tuple (keys, years, values):
+
+            keys: list of (state, sector, energy_type) tuples, one per series
+            years: array of years, ascending
+            values: (series x years) array of energy consumption
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+    """
+    keys = []
+    rows = []
+    index = None
+    frame_index = None
+
+    for state in state_dfs:
+        for sector in state_dfs[state]:
+            df = state_dfs[state][sector]
+
+            # All series are reported over the same years
+            if index is None:
+                index = df.index.sort_values()
+
+            # Row positions in the ascending index. Frames nearly always share one index, so
+            # this is computed once rather than sorting and reindexing every frame.
+            if frame_index is None or not df.index.equals(frame_index):
+                frame_index = df.index
+                positions = index.get_indexer(frame_index)
+                found = positions >= 0
+
+            # Take every energy column of the frame as one block rather than one at a time
+            energy_columns = ~df.columns.isin(non_energy_columns)
+            keys.extend((state, sector, energy_type) for energy_type in df.columns[energy_columns])
+
+            block = np.full((len(index), energy_columns.sum()), np.nan)
+            block[positions[found]] = df.to_numpy(dtype=float)[found][:, energy_columns]
+            rows.append(block.T)
+
+    values = np.concatenate(rows)
+
+    return keys, np.array(index.year), values
+
+
+def fit_trends(values, years, horizon=5, fit_years=18, degree=1, z=Z_95):
+    """
+    Returns
+    -------
+
+        A tuple (mean, lower, upper) of (series x horizon) arrays with the forecast
+        and prediction interval for each of the next horizon years.
+
+        Series with missing values in the fit window get NaN forecasts.
+
+    Parameters
+    -----------
+
+        values: [np.array] (series x years) array, e.g. from get_series_cube()
+
+        years: [np.array] Years of the columns of values, ascending
+
+        horizon: [int] Number of years to forecast past the last year
+
+        fit_years: [int] Number of trailing years to fit on
+
+        degree: [int] Degree of the polynomial trend. 1 is a straight line.
+
+        z: [float] Normal quantile for the width of the prediction interval
+    """
+    y = values[:, -fit_years:]
+    x = (years[-fit_years:] - years[-1]).astype(float)
+    x_future = np.arange(1, horizon + 1, dtype=float)
+
+    # Shared design matrices: one column per polynomial power
+    X = np.vander(x, degree + 1, increasing=True)
+    X_future = np.vander(x_future, degree + 1, increasing=True)
+    XtX_inv = np.linalg.inv(X.T @ X)
+
+    # Every fit at once: (series x years) @ (years x p) @ (p x p)
+    coefs = y @ X @ XtX_inv
+
+    residuals = y - coefs @ X.T
+    dof = max(fit_years - (degree + 1), 1)
+    sigma2 = (residuals ** 2).sum(axis=1) / dof
+
+    mean = coefs @ X_future.T
+
+    # Var(prediction) = sigma^2 * (1 + x0 (X'X)^-1 x0')
+    leverage = np.einsum('ij,jk,ik->i', X_future, XtX_inv, X_future)
+    half_width = z * np.sqrt(sigma2[:, None] * (1 + leverage[None, :]))
+
+    return mean, mean - half_width, mean + half_width
+
+
+def _fit_trends_chunk(args):
+    """
+    Unpacks a tuple of arguments for fit_trends() so it can be mapped over a process pool.
+    """
+    return fit_trends(*args)
+
+
+def get_forecast_cube(state_dfs, horizon=5, fit_years=18, degree=1, n_jobs=1, chunk_size=5000):
+    """
+    Returns
+    -------
+
+        A dict with a forecast for every series in state_dfs:
+
+        {'keys': list of (state, sector, energy_type),
+         'years': array of forecast years,
+         'mean', 'lower', 'upper': (series x horizon) arrays,
+         'positions': {(state, sector, energy_type): row} lookup table
+        }
+
+        The cube is read from concurrent dash callbacks, so it is complete
+        when returned and never written to afterwards.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+
+        horizon: [int] Number of years to forecast past the last year
+
+        fit_years: [int] Number of trailing years to fit on
+
+        degree: [int] Degree of the polynomial trend
+
+        n_jobs: [int] Number of processes. The stacked fit is already fast, so this only
+                pays off for very large cubes or higher degree models.
+
+        chunk_size: [int] Number of series sent to each process at a time
+    """
+    keys, years, values = get_series_cube(state_dfs)
+
+    if n_jobs > 1 and len(values) > chunk_size:
+        chunks = [(values[i:i + chunk_size], years, horizon, fit_years, degree)
+                  for i in range(0, len(values), chunk_size)]
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_fit_trends_chunk, chunks))
+
+        mean, lower, upper = [np.concatenate(parts) for parts in zip(*results)]
+    else:
+        mean, lower, upper = fit_trends(values, years, horizon, fit_years, degree)
+
+    return {'keys': keys,
+            'years': years[-1] + np.arange(1, horizon + 1),
+            'mean': mean,
+            'lower': lower,
+            'upper': upper,
+            'positions': {key: i for i, key in enumerate(keys)}}
+
+
+def get_series_forecast(forecast_cube, state, sector, energy_type):
+    """
+    Returns
+    -------
+
+        A dataframe indexed by forecast year with columns mean, lower and upper.
+
+    Parameters
+    -----------
+
+        forecast_cube: [dict] Output of get_forecast_cube()
+
+        state: [str] e.g. 'New York'
+
+        sector: [str] e.g. 'Total All Sectors'
+
+        energy_type: [str] e.g. 'Renewable Sources'
+    """
+    i = forecast_cube['positions'][(state, sector, energy_type)]
+
+    return pd.DataFrame({'mean': forecast_cube['mean'][i],
+                         'lower': forecast_cube['lower'][i],
+                         'upper': forecast_cube['upper'][i]},
+                        index=forecast_cube['years'])
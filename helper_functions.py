@@ -3,6 +3,8 @@ import time
 from bs4 import BeautifulSoup as BS
 import csv
 import pymongo
+from bson.binary import Binary
+from bson.objectid import ObjectId
 import numpy as np
 import pandas as pd
 import plotly.express as px
@@ -31,6 +33,9 @@ mydb = client['energy_data']
 
 energy_collection = mydb['energy_data']
 
+# Same series, bucketed by decade for range and cross-section queries (see build_bucket_collection)
+bucket_collection = mydb['energy_buckets']
+
 # Get dict with state abbreviations and full names
 state_abbrevs = open('state-abbreviations.csv')
 state_abbrevs_reader = csv.reader(state_abbrevs)
@@ -156,17 +161,8 @@ def get_energy_pop_df(state_data,sector):
         # Make sure we are only grabbing the desired sector
         if series.get('sector') == sector:
 
-            data = series['data']
-
-            # Some series only go to 2017 so we'll cut off any ones that go to 2018
-            if len(data) == 59:
-                data = data[1:]
-
-            # Store just the energy values
-            ts_values = [tuple_[1] for tuple_ in data]
-
             # Add to df
-            df = pd.concat([df, pd.Series(data = ts_values,
+            df = pd.concat([df, pd.Series(data = get_series_values(series),
                                           name=(series['energy_type']),
                                           index=df.index
                                          )],
@@ -174,17 +170,8 @@ def get_energy_pop_df(state_data,sector):
         # Also grab population data
         if series.get('description') == 'Population':
 
-            data = series['data']
-
-            # Some series only go to 2017 so we'll cut off any ones that go to 2018
-            if len(data) == 59:
-                data = data[1:]
-
-            # Store just the population values
-            ts_values = [tuple_[1] for tuple_ in data]
-
             # Add to df
-            df = pd.concat([df, pd.Series(data = ts_values,
+            df = pd.concat([df, pd.Series(data = get_series_values(series),
                                           name=series.get('description'),
                                           index=df.index)],
                            axis=1)
@@ -193,6 +180,326 @@ def get_energy_pop_df(state_data,sector):
 
     return df
 
+"""
+PACKED SERIES LAYOUT
+--------------------
+
+    Series can be stored either as the original list of [year_string, value]
+    pairs in 'data', or packed: a start year, a frequency and the values as
+    little-endian float64 bytes in 'values', oldest year first. Packed
+    documents are a fraction of the size and decode straight into a numpy
+    array without any Python-level loop. Readers accept both layouts.
+"""
+
+def encode_series_data(data):
+    """
+    Returns
+    -------
+
+        A dict with the packed layout fields: start_year, freq and values.
+
+    Parameters
+    -----------
+
+        data: [list] List of [year_string, value] pairs as stored by the ETL, in any order.
+              Missing years and None values are stored as NaN.
+    """
+    years = [int(pair[0]) for pair in data]
+    start_year = min(years)
+
+    values = np.full(max(years) - start_year + 1, np.nan)
+    for year, pair in zip(years, data):
+        if pair[1] is not None:
+            values[year - start_year] = pair[1]
+
+    return {'start_year': start_year,
+            'freq': 'A',
+            'values': Binary(values.astype('<f8').tobytes())}
+
+def decode_series_data(series):
+    """
+    Returns
+    -------
+
+        A tuple (start_year, values) where values is a float64 array, oldest year first.
+        For packed documents the array is a read-only view on the document's bytes.
+
+    Parameters
+    -----------
+
+        series: [dict] A single series document, in either layout
+    """
+    if 'values' not in series:
+        series = encode_series_data(series['data'])
+
+    return series['start_year'], np.frombuffer(series['values'], dtype='<f8')
+
+def get_series_values(series, first_year=1960, last_year=2017):
+    """
+    Returns
+    -------
+
+        The values of a series from last_year back to first_year, matching the
+        descending date index used by get_energy_pop_df().
+
+    Parameters
+    -----------
+
+        series: [dict] A single series document, in either layout
+
+        first_year: [int] Oldest year to return
+
+        last_year: [int] Most recent year to return
+    """
+    if 'values' not in series:
+        data = series['data']
+
+        # Some series only go to 2017 so we'll cut off any ones that go to 2018
+        if len(data) == 59:
+            data = data[1:]
+
+        # Store just the values
+        return [tuple_[1] for tuple_ in data]
+
+    start_year, values = decode_series_data(series)
+
+    # Series that don't cover the whole range get padded with NaN (this one does copy)
+    if start_year > first_year or start_year + len(values) - 1 < last_year:
+        padded = np.full(last_year - first_year + 1, np.nan)
+        overlap = values[max(first_year - start_year, 0):last_year - start_year + 1]
+        offset = max(start_year - first_year, 0)
+        padded[offset:offset + len(overlap)] = overlap
+        return padded[::-1]
+
+    # Slicing and reversing a numpy array are both views, so nothing is copied here
+    return values[first_year - start_year:last_year - start_year + 1][::-1]
+
+def migrate_energy_collection(collection=None, batch_size=1000):
+    """
+    Returns
+    -------
+
+        The number of documents converted to the packed layout.
+
+        Documents whose 'data' is a list of [year, value] pairs get the packed
+        fields and lose 'data'. Anything else (e.g. the temperature documents)
+        is left alone, as are documents that are already packed. Safe to rerun.
+
+    Parameters
+    -----------
+
+        collection: [pymongo.collection.Collection] Defaults to the energy collection
+
+        batch_size: [int] Number of updates sent to MongoDB at a time
+    """
+    if collection is None:
+        collection = energy_collection
+
+    requests_ = []
+    n_migrated = 0
+
+    for series in collection.find({'data': {'$type': 'array'}, 'values': {'$exists': False}}):
+        requests_.append(pymongo.UpdateOne({'_id': series['_id']},
+                                           {'$set': encode_series_data(series['data']),
+                                            '$unset': {'data': ''}}))
+
+        if len(requests_) == batch_size:
+            n_migrated += collection.bulk_write(requests_).modified_count
+            requests_ = []
+
+    if requests_:
+        n_migrated += collection.bulk_write(requests_).modified_count
+
+    return n_migrated
+
+"""
+DECADE BUCKETS
+--------------
+
+    An alternative layout for range and cross-section queries such as "every
+    state's Coal consumption from 2005 to 2017". Each series is split into one
+    document per decade:
+
+        {state, sector, energy_type, decade, start_year, values}
+
+    with values packed like encode_series_data(). Compound indexes on
+    (energy_type, sector, decade, state) and (state, sector, energy_type, decade)
+    let both kinds of query be answered from the index, fetching at most one
+    extra partial decade at each end of the range instead of every full series.
+"""
+
+def get_bucket_documents(series):
+    """
+    Returns
+    -------
+
+        A list of decade bucket documents for a single series.
+
+    Parameters
+    -----------
+
+        series: [dict] A single series document, in either layout
+    """
+    start_year, values = decode_series_data(series)
+    years = np.arange(start_year, start_year + len(values))
+
+    buckets = []
+    for decade in np.unique(years // 10 * 10):
+        in_decade = (years >= decade) & (years < decade + 10)
+        buckets.append({'state': series['state'],
+                        'sector': series['sector'],
+                        'energy_type': series['energy_type'],
+                        'decade': int(decade),
+                        'start_year': int(years[in_decade][0]),
+                        'values': Binary(values[in_decade].astype('<f8').tobytes())})
+
+    return buckets
+
+def build_bucket_collection(source=None, target=None):
+    """
+    Returns
+    -------
+
+        The number of bucket documents written.
+
+        Rebuilds the bucket collection from the per-series documents and
+        creates the compound indexes the range queries rely on.
+
+        The buckets are written to a temporary collection, indexed, and then
+        renamed over the live one, so readers see either the old buckets or
+        the complete new ones and never an empty or half-filled collection.
+
+    Parameters
+    -----------
+
+        source: [pymongo.collection.Collection] Per-series documents. Defaults to the energy collection.
+
+        target: [pymongo.collection.Collection] Bucket collection. Defaults to bucket_collection.
+    """
+    if source is None:
+        source = energy_collection
+    if target is None:
+        target = bucket_collection
+
+    # Unique name, so concurrent rebuilds don't write into each other's collection
+    staging = target.database[target.name + '_build_' + str(ObjectId())]
+
+    buckets = []
+    for series in source.find({'sector': {'$exists': True}}):
+        buckets.extend(get_bucket_documents(series))
+
+    try:
+        if buckets:
+            staging.insert_many(buckets)
+
+        # Cross-section queries: one fuel and sector, many states
+        staging.create_index([('energy_type', pymongo.ASCENDING), ('sector', pymongo.ASCENDING),
+                              ('decade', pymongo.ASCENDING), ('state', pymongo.ASCENDING)])
+
+        # Per-state queries: one state and sector, many fuels
+        staging.create_index([('state', pymongo.ASCENDING), ('sector', pymongo.ASCENDING),
+                              ('energy_type', pymongo.ASCENDING), ('decade', pymongo.ASCENDING)])
+
+        # Replaces the live collection in one step
+        staging.rename(target.name, dropTarget=True)
+    except Exception:
+        staging.drop()
+        raise
+
+    return len(buckets)
+
+def get_buckets_df(query, start_year, end_year, column, collection=None):
+    """
+    Returns
+    -------
+
+        A dataframe with a datetime index from start_year to end_year and one
+        column per distinct value of the given field among the matching buckets.
+
+    Parameters
+    -----------
+
+        query: [dict] Filter on state, sector and/or energy_type
+
+        start_year: [int] First year to return
+
+        end_year: [int] Last year to return
+
+        column: [str] Bucket field that becomes the columns, e.g. 'state'
+
+        collection: [pymongo.collection.Collection] Defaults to bucket_collection
+    """
+    if collection is None:
+        collection = bucket_collection
+
+    query = dict(query)
+    query['decade'] = {'$gte': start_year // 10 * 10, '$lte': end_year // 10 * 10}
+
+    years = np.arange(start_year, end_year + 1)
+    columns = {}
+
+    for bucket in collection.find(query, {'_id': 0, column: 1, 'start_year': 1, 'values': 1}):
+        values = np.frombuffer(bucket['values'], dtype='<f8')
+        bucket_years = np.arange(bucket['start_year'], bucket['start_year'] + len(values))
+
+        if bucket[column] not in columns:
+            columns[bucket[column]] = np.full(len(years), np.nan)
+
+        # Only keep the points inside the requested range
+        in_range = (bucket_years >= start_year) & (bucket_years <= end_year)
+        columns[bucket[column]][bucket_years[in_range] - start_year] = values[in_range]
+
+    index = pd.to_datetime([str(year) for year in years])
+    index.name = 'Date'
+
+    return pd.DataFrame(columns, index=index)[sorted(columns)]
+
+def get_energy_cross_section(energy_type, start_year, end_year, sector='Total All Sectors', states=None):
+    """
+    Returns
+    -------
+
+        A dataframe with a datetime index from start_year to end_year and one column per state.
+
+    Parameters
+    -----------
+
+        energy_type: [str] e.g. 'Coal'
+
+        start_year: [int] First year to return
+
+        end_year: [int] Last year to return
+
+        sector: [str] Sector to query
+
+        states: [list] Only return these states. Defaults to all of them.
+    """
+    query = {'energy_type': energy_type, 'sector': sector}
+    if states is not None:
+        query['state'] = {'$in': list(states)}
+
+    return get_buckets_df(query, start_year, end_year, 'state')
+
+def get_state_range(state, start_year, end_year, sector='Total All Sectors'):
+    """
+    Returns
+    -------
+
+        A dataframe with a datetime index from start_year to end_year and one column per energy type.
+
+    Parameters
+    -----------
+
+        state: [str] e.g. 'New York'
+
+        start_year: [int] First year to return
+
+        end_year: [int] Last year to return
+
+        sector: [str] Sector to query
+    """
+    return get_buckets_df({'state': state, 'sector': sector}, start_year, end_year, 'energy_type')
+
 def create_energy_columns(df):
     """
     Returns
@@ -271,7 +578,31 @@ def get_weather_df(state_data):
     return df
 
 
-def get_states_data():
+def get_states_documents(collection=None):
+    """
+    Returns
+    -------
+
+        A dict {state_name: [documents]} with every MongoDB document of every state,
+        fetched with a single query.
+
+    Parameters
+    -----------
+
+        collection: [pymongo.collection.Collection] Defaults to energy_collection
+    """
+    if collection is None:
+        collection = energy_collection
+
+    # Keep the usual state order
+    documents = {state_abbrevs_dict[state]: [] for state in state_abbrevs_dict}
+
+    for document in collection.find({'state': {'$in': list(documents)}}):
+        documents[document['state']].append(document)
+
+    return documents
+
+def get_states_data(documents=None):
     """
     Returns
     -------
@@ -288,14 +619,18 @@ def get_states_data():
         Typically, we want to access data from a single sector across all states,
         so this is a convenient format to store everything
 
+    Parameters
+    -----------
+
+        documents: [dict] Output of get_states_documents(). Loaded from MongoDB if not given.
+
     """
 
+    if documents is None:
+        documents = get_states_documents()
 
     # Store each state's data from mongodb into a list
-    states_data = []
-    for state in state_abbrevs_dict:
-        data = [x for x in energy_collection.find({'state':state_abbrevs_dict[state]})]
-        states_data.append({'state':state_abbrevs_dict[state], 'data':data})
+    states_data = [{'state':state, 'data':data} for state, data in documents.items()]
 
     # Create list of unique sector names
     sectors = [series.get('sector') for series in states_data[0]['data'] if series.get('sector')]
@@ -309,14 +644,20 @@ def get_states_data():
 
     return state_dfs
 
-def get_sustainability_indicators():
+def get_sustainability_indicators(state_dfs=None):
     """
     Returns
     -------
 
         A dict with the green score and effort score of every state.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of get_states_data(). Loaded from MongoDB if not given.
     """
-    state_dfs = get_states_data()
+    if state_dfs is None:
+        state_dfs = get_states_data()
 
     # Create empty container to store the final processed data (sustainability indicators)
     sus_indicators = {}
@@ -338,7 +679,8 @@ def get_sustainability_indicators():
         """
 
         # Calculate the differences from the year 2000 onward
-        diff = (nec - rec)[:'2000-01-01'].sort_index(ascending=True)
+        # Sort before slicing: label slices of the descending index depend on the pandas version
+        diff = (nec - rec).sort_index(ascending=True)['2000-01-01':]
 
         # Create empty bin to store integral values
         integrals = []
@@ -368,7 +710,7 @@ def get_sustainability_indicators():
         """
 
         # Take ratio of rec/nec from 2000 onward
-        ratios = (rec/nec)[:'2000-01-01'].sort_index(ascending=True)
+        ratios = (rec/nec).sort_index(ascending=True)['2000-01-01':]
 
         # Store average as green_score
         green_score = round(ratios.mean(),3)
@@ -383,7 +725,7 @@ def get_sustainability_indicators():
 
     return sus_indicators
 
-def get_sustainability_df():
+def get_sustainability_df(sus_indicators=None):
 
     """
     Returns
@@ -391,9 +733,16 @@ def get_sustainability_df():
 
         A df with green score, effort score, and sustainability indexes for each state.
 
+    Parameters
+    -----------
+
+        sus_indicators: [dict] Output of get_sustainability_indicators(), or anything in the same
+                        format. Computed from MongoDB if not given.
+
     """
 
-    sus_indicators = get_sustainability_indicators()
+    if sus_indicators is None:
+        sus_indicators = get_sustainability_indicators()
 
     # Put this data into a form that can easily be inserted into a df
     data = {'Effort Score' : [sus_indicators[state]['effort_score'] for state in sus_indicators],
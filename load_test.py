@@ -0,0 +1,316 @@
+"""
+Load generator for the dash app.
+
+Simulates users interacting with the dashboard by replaying realistic
+sequences of interactions (dragging the SI slider, hovering over states on
+the map, changing the state dropdown, toggling the radio items and dragging
+the year range slider) against the app's callback endpoint. Each
+interaction fires every callback that listens to the changed property,
+exactly like the browser would.
+
+The callbacks and the initial value of every component are read from the
+running app, so new callbacks are picked up without changing this file.
+
+Usage (with app.py running):
+
+    python load_test.py --url http://127.0.0.1:8050 --users 20 --duration 30
+
+Reports p50/p95/p99 latency, error count and throughput for each callback.
+The same --seed always replays the same interactions.
+"""
+
+import argparse
+import csv
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+"""
+DISCOVERY
+---------
+"""
+
+
+def get_json(connection, path):
+    """
+    Returns
+    -------
+
+        The decoded JSON response of a GET request.
+    """
+    connection.request('GET', path)
+    response = connection.getresponse()
+
+    return json.loads(response.read())
+
+
+def get_initial_values(layout):
+    """
+    Returns
+    -------
+
+        A dict {'component_id.property': value} of every prop of every component with an id in the layout.
+
+    Parameters
+    -----------
+
+        layout: [dict] Output of the /_dash-layout endpoint
+    """
+    values = {}
+    to_visit = [layout]
+
+    while to_visit:
+        node = to_visit.pop()
+
+        if isinstance(node, list):
+            to_visit.extend(node)
+            continue
+        if not isinstance(node, dict) or 'props' not in node:
+            continue
+
+        props = node['props']
+        if 'id' in props:
+            for prop, value in props.items():
+                values[f'{props["id"]}.{prop}'] = value
+
+        to_visit.append(props.get('children'))
+
+    return values
+
+
+def parse_outputs(output):
+    """
+    Returns
+    -------
+
+        The outputs payload for a callback's output string: a dict for a single
+        output, or a list of dicts for multi-output callbacks ('..a.figure...b.children..').
+    """
+    def parse(single):
+        component_id, prop = single.rsplit('.', 1)
+        return {'id': component_id, 'property': prop}
+
+    if output.startswith('..'):
+        return [parse(single) for single in output[2:-2].split('...')]
+
+    return parse(output)
+
+
+"""
+INTERACTIONS
+------------
+
+    Each interaction is a list of (property, value) changes a user makes in a
+    row, e.g. the successive values of a slider while it's being dragged.
+"""
+
+
+def get_interactions(rng, state_codes, state_names):
+    """
+    Returns
+    -------
+
+        A dict of {interaction name: function returning a list of (property, value) changes}.
+    """
+    def slider_drag():
+        start, stop = sorted(rng.sample(range(11), 2))
+        return [('si_slider.value', round(step / 10, 1)) for step in range(start, stop + 1)]
+
+    def map_hover():
+        codes = rng.sample(state_codes, rng.randint(1, 5))
+        return [('crossfilter_map_with_slider.hoverData', {'points': [{'location': code}]}) for code in codes]
+
+    def dropdown_change():
+        return [('state_dropdown.value', rng.choice(state_names))]
+
+    def radio_toggle():
+        return [('source_radio_item.value', rng.choice(['sector', 'fuel']))]
+
+    def layer_toggle():
+        return [('map_layer_radio_item.value', rng.choice(['si', 'cluster']))]
+
+    def window_drag():
+        start = rng.randint(1960, 2010)
+        return [('window_slider.value', [start, end]) for end in range(start + 3, min(start + 10, 2017) + 1)]
+
+    return {'slider_drag': slider_drag,
+            'map_hover': map_hover,
+            'dropdown_change': dropdown_change,
+            'radio_toggle': radio_toggle,
+            'layer_toggle': layer_toggle,
+            'window_drag': window_drag}
+
+
+"""
+VIRTUAL USERS
+-------------
+"""
+
+
+def run_user(url, callbacks, initial_values, interactions, duration, seed, results, lock, think_time):
+    """
+    Runs one virtual user until duration seconds have passed, appending
+    (callback output, latency in seconds, succeeded) tuples to results.
+    """
+    rng = random.Random(seed)
+    parsed = urlparse(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+    values = dict(initial_values)
+    names = sorted(interactions)
+    user_results = []
+
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for prop, value in interactions[rng.choice(names)]():
+            values[prop] = value
+
+            # Fire every callback that listens to this property
+            for callback in callbacks:
+                input_ids = [f'{item["id"]}.{item["property"]}' for item in callback['inputs']]
+                if prop not in input_ids:
+                    continue
+
+                payload = {'output': callback['output'],
+                           'outputs': parse_outputs(callback['output']),
+                           'inputs': [dict(item, value=values.get(f'{item["id"]}.{item["property"]}'))
+                                      for item in callback['inputs']],
+                           'state': [dict(item, value=values.get(f'{item["id"]}.{item["property"]}'))
+                                     for item in callback.get('state', [])],
+                           'changedPropIds': [prop]}
+                body = json.dumps(payload)
+
+                start = time.perf_counter()
+                try:
+                    connection.request('POST', parsed.path.rstrip('/') + '/_dash-update-component', body,
+                                       {'Content-Type': 'application/json'})
+                    response = connection.getresponse()
+                    response.read()
+                    succeeded = response.status in (200, 204)
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+                    succeeded = False
+                user_results.append((callback['output'], time.perf_counter() - start, succeeded))
+
+            if think_time:
+                time.sleep(rng.uniform(0, think_time))
+
+    connection.close()
+
+    with lock:
+        results.extend(user_results)
+
+
+def run_load_test(url, users=10, duration=30, seed=0, think_time=0.0):
+    """
+    Returns
+    -------
+
+        A tuple (results, elapsed) where results is a list of (callback output, latency, succeeded).
+
+    Parameters
+    -----------
+
+        url: [str] Base url of the running dash app
+
+        users: [int] Number of concurrent virtual users
+
+        duration: [float] Seconds each user keeps interacting
+
+        seed: [int] Seed for the interaction sequences
+
+        think_time: [float] Maximum pause between interactions, in seconds
+    """
+    parsed = urlparse(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+    base_path = parsed.path.rstrip('/')
+    callbacks = get_json(connection, base_path + '/_dash-dependencies')
+    initial_values = get_initial_values(get_json(connection, base_path + '/_dash-layout'))
+    connection.close()
+
+    # Same state list the app uses
+    with open('state-abbreviations.csv') as f:
+        state_abbrevs_dict = dict(csv.reader(f))
+    state_codes = sorted(state_abbrevs_dict)
+    state_names = [state_abbrevs_dict[code] for code in state_codes]
+
+    results = []
+    lock = threading.Lock()
+    threads = []
+
+    for user in range(users):
+        interactions = get_interactions(random.Random(seed * 100003 + user), state_codes, state_names)
+        threads.append(threading.Thread(target=run_user,
+                                        args=(url, callbacks, initial_values, interactions, duration,
+                                              seed * 100003 + user, results, lock, think_time)))
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, time.time() - start
+
+
+def summarize(results, elapsed):
+    """
+    Returns
+    -------
+
+        A dict {callback output: {'requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'rps'}},
+        plus an 'ALL' entry across every callback.
+    """
+    by_callback = {}
+    for output, latency, succeeded in results:
+        by_callback.setdefault(output, []).append((latency, succeeded))
+    by_callback['ALL'] = [(latency, succeeded) for _, latency, succeeded in results]
+
+    summary = {}
+    for output, rows in by_callback.items():
+        if not rows:
+            continue
+        latencies = np.array([latency for latency, _ in rows]) * 1000
+        summary[output] = {'requests': len(rows),
+                           'errors': sum(not succeeded for _, succeeded in rows),
+                           'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+                           'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+                           'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+                           'rps': round(len(rows) / elapsed, 1)}
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay dashboard interactions against a running dash app.')
+    parser.add_argument('--url', default='http://127.0.0.1:8050')
+    parser.add_argument('--users', type=int, default=10, help='Number of concurrent virtual users.')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds each user keeps interacting.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--think-time', type=float, default=0.0, help='Maximum pause between interactions.')
+    parser.add_argument('--json', help='Also write the summary to this file.')
+    args = parser.parse_args()
+
+    results, elapsed = run_load_test(args.url, args.users, args.duration, args.seed, args.think_time)
+    summary = summarize(results, elapsed)
+
+    print(f'{args.users} users for {elapsed:.1f}s')
+    print(f'{"callback":<45}{"requests":>10}{"errors":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"req/s":>10}')
+    for output in sorted(summary, key=lambda output: output == 'ALL'):
+        row = summary[output]
+        print(f'{output:<45}{row["requests"]:>10}{row["errors"]:>8}{row["p50_ms"]:>10}'
+              f'{row["p95_ms"]:>10}{row["p99_ms"]:>10}{row["rps"]:>10}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+"""
+Command line runner for the ETL process in ETL.py.
+
+The ETL is split into stages:
+
+    crawl       scrape the EIA query browser for the series ids we want
+    parse_seds  parse the SEDS bulk file
+    map_series  pick out and reshape the series found by crawl
+    load        upsert the series into MongoDB
+    bucket      rebuild the decade bucket collection used for range queries
+
+Each stage's output is pickled into an artifact named after the hash of its
+contents. A stage is skipped when a previous run already produced an
+artifact from the same inputs (the same upstream artifacts, parameters and
+source files), so a failed run picks up from the last stage that finished.
+The crawl has no upstream inputs, so its results are keyed on the crawl
+period instead and the query browser is scraped again once they are older
+than --crawl-ttl-days.
+Stages that don't depend on each other run in parallel.
+
+Usage:
+
+    python pipeline.py                      # run everything that is out of date
+    python pipeline.py --force crawl        # rescrape even if nothing changed
+    python pipeline.py --crawl-ttl-days 7   # rescrape series ids older than a week
+    python pipeline.py --stages crawl parse_seds
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ARTIFACT_DIR = 'not_for_git/artifacts'
+CRAWL_TTL_DAYS = 30
+
+
+"""
+STAGES
+------
+
+    Each stage lists the stages it depends on, the parameters passed to its
+    function and any source files it reads. Its function is called with the
+    outputs of its dependencies (in order) followed by its parameters.
+"""
+
+
+def _crawl(base_url, headers, crawl_period):
+    # crawl_period only keys the artifact, so a new period reruns the crawl
+    import ETL
+    return ETL.crawl_series_ids(base_url, headers)
+
+
+def _parse_seds(seds_path):
+    import ETL
+    return ETL.parse_seds(seds_path)
+
+
+def _map_series(json_data, env_series_ids):
+    import ETL
+    return ETL.map_series(json_data, env_series_ids)
+
+
+def _load(environmental_data, mongo_url, packed):
+    import ETL
+    return ETL.load_series(environmental_data, mongo_url, packed)
+
+
+def _bucket(load_receipt, mongo_url):
+    import pymongo
+    import helper_functions
+    mydb = pymongo.MongoClient(mongo_url)['energy_data']
+    n_buckets = helper_functions.build_bucket_collection(mydb['energy_data'], mydb['energy_buckets'])
+    return {'version': load_receipt['version'], 'n_buckets': n_buckets}
+
+
+def get_stages(seds_path='not_for_git/SEDS.txt', mongo_url='mongodb://localhost/', packed=False,
+               crawl_ttl_days=CRAWL_TTL_DAYS):
+    """
+    Returns
+    -------
+
+        A dict of {stage name: stage definition}, in an order where every stage comes after its dependencies.
+
+    Parameters
+    -----------
+
+        seds_path: [str] Path to the SEDS text file
+
+        mongo_url: [str] MongoDB connection string
+
+        packed: [bool] Store series in the packed binary layout
+
+        crawl_ttl_days: [float] How long crawled series ids are reused before the crawl runs again
+    """
+    headers = {'user-agent': 'Safari/13.0.2 (Macintosh; Intel Mac OS X 10_15)'}
+
+    # Number of whole TTLs since the epoch. It changes once per TTL, which changes the crawl's input key.
+    crawl_period = int(time.time() // (crawl_ttl_days * 24 * 3600))
+
+    return {
+        'crawl': {'function': _crawl,
+                  'depends_on': [],
+                  'params': {'base_url': 'https://www.eia.gov/opendata/qb.php', 'headers': headers,
+                             'crawl_period': crawl_period},
+                  'sources': []},
+        'parse_seds': {'function': _parse_seds,
+                       'depends_on': [],
+                       'params': {'seds_path': seds_path},
+                       'sources': [seds_path]},
+        'map_series': {'function': _map_series,
+                       'depends_on': ['parse_seds', 'crawl'],
+                       'params': {},
+                       'sources': []},
+        'load': {'function': _load,
+                 'depends_on': ['map_series'],
+                 'params': {'mongo_url': mongo_url, 'packed': packed},
+                 'sources': []},
+        'bucket': {'function': _bucket,
+                   'depends_on': ['load'],
+                   'params': {'mongo_url': mongo_url},
+                   'sources': []},
+    }
+
+
+"""
+ARTIFACTS
+---------
+"""
+
+
+def hash_file(path):
+    """
+    Returns
+    -------
+
+        The sha256 hex digest of a file's contents, read in 1MB blocks.
+
+    Parameters
+    -----------
+
+        path: [str] Path to the file
+    """
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def get_input_key(name, stage, manifest):
+    """
+    Returns
+    -------
+
+        A hex digest of everything that determines a stage's output: its name, parameters,
+        the artifacts of its dependencies and the contents of its source files.
+
+    Parameters
+    -----------
+
+        name: [str] Name of the stage
+
+        stage: [dict] Stage definition from get_stages()
+
+        manifest: [dict] Current manifest, used to look up the dependencies' artifacts
+    """
+    key = {'stage': name,
+           'params': stage['params'],
+           'inputs': [manifest[dependency]['artifact'] for dependency in stage['depends_on']],
+           'sources': [hash_file(source) for source in stage['sources']]}
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def write_file(path, data):
+    """
+    Writes data to path through a temporary file of its own in the same
+    directory and renames it into place, so readers never see a half-written
+    file and stages finishing at once don't clobber each other's temporary files.
+
+    Parameters
+    -----------
+
+        path: [str] Path to write to
+
+        data: [bytes] Contents of the file
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def save_artifact(output, artifact_dir):
+    """
+    Returns
+    -------
+
+        The content hash of output, which is also the name of the artifact it was saved to.
+
+    Parameters
+    -----------
+
+        output: [object] Anything picklable returned by a stage
+
+        artifact_dir: [str] Directory artifacts are stored in
+    """
+    payload = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+    content_hash = hashlib.sha256(payload).hexdigest()
+
+    path = os.path.join(artifact_dir, content_hash + '.pickle')
+
+    # Identical outputs share one file
+    if not os.path.exists(path):
+        write_file(path, payload)
+
+    return content_hash
+
+
+def load_artifact(content_hash, artifact_dir):
+    """
+    Returns
+    -------
+
+        The output stored in the artifact.
+
+    Parameters
+    -----------
+
+        content_hash: [str] Name of the artifact, as returned by save_artifact()
+
+        artifact_dir: [str] Directory artifacts are stored in
+    """
+    with open(os.path.join(artifact_dir, content_hash + '.pickle'), 'rb') as f:
+        return pickle.load(f)
+
+
+def load_manifest(artifact_dir):
+    """
+    Returns
+    -------
+
+        The manifest of the last run: {stage: {'input_key': ..., 'artifact': ...}}
+
+    Parameters
+    -----------
+
+        artifact_dir: [str] Directory artifacts are stored in
+    """
+    path = os.path.join(artifact_dir, 'manifest.json')
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, artifact_dir):
+    """
+    Writes the manifest. Called after every stage that finishes, which is what makes runs resumable.
+
+    Parameters
+    -----------
+
+        manifest: [dict] {stage: {'input_key': ..., 'artifact': ...}}
+
+        artifact_dir: [str] Directory artifacts are stored in
+    """
+    write_file(os.path.join(artifact_dir, 'manifest.json'),
+               json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+
+"""
+RUNNER
+------
+"""
+
+
+def is_up_to_date(name, input_key, manifest, artifact_dir):
+    """
+    Returns
+    -------
+
+        True if the manifest has an artifact for this stage computed from the same inputs.
+    """
+    entry = manifest.get(name)
+
+    return (entry is not None
+            and entry['input_key'] == input_key
+            and os.path.exists(os.path.join(artifact_dir, entry['artifact'] + '.pickle')))
+
+
+def run_stage(name, stage, input_key, manifest, artifact_dir):
+    """
+    Returns
+    -------
+
+        The content hash of the stage's output artifact.
+
+    Parameters
+    -----------
+
+        name: [str] Name of the stage
+
+        stage: [dict] Stage definition from get_stages()
+
+        input_key: [str] Output of get_input_key()
+
+        manifest: [dict] Current manifest, used to find the dependencies' artifacts
+
+        artifact_dir: [str] Directory artifacts are stored in
+    """
+    inputs = [load_artifact(manifest[dependency]['artifact'], artifact_dir)
+              for dependency in stage['depends_on']]
+
+    start = time.time()
+    output = stage['function'](*inputs, **stage['params'])
+    print(f'{name}: finished in {time.time() - start:.1f}s')
+
+    return save_artifact(output, artifact_dir)
+
+
+def run_pipeline(stages, targets=None, force=(), jobs=2, artifact_dir=ARTIFACT_DIR):
+    """
+    Returns
+    -------
+
+        The manifest after the run.
+
+        Stages run in waves: every stage whose dependencies are done runs in
+        the same wave, in parallel. If a stage fails, the stages that finished
+        are already checkpointed in the manifest, so rerunning resumes from there.
+
+    Parameters
+    -----------
+
+        stages: [dict] Output of get_stages()
+
+        targets: [list] Stages to bring up to date, along with their dependencies. Defaults to all.
+
+        force: [iterable] Stages to rerun even if they are up to date
+
+        jobs: [int] Maximum number of stages to run at once
+
+        artifact_dir: [str] Directory artifacts are stored in
+    """
+    os.makedirs(artifact_dir, exist_ok=True)
+    manifest = load_manifest(artifact_dir)
+
+    # Collect the targets and everything they depend on
+    needed = set()
+    to_visit = list(targets or stages)
+    while to_visit:
+        name = to_visit.pop()
+        assert name in stages, f'Unknown stage {name}. Choose from {list(stages)}'
+        if name not in needed:
+            needed.add(name)
+            to_visit.extend(stages[name]['depends_on'])
+
+    done = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while needed - done:
+            wave = [name for name in stages
+                    if name in needed - done and all(dependency in done for dependency in stages[name]['depends_on'])]
+
+            futures = {}
+            for name in wave:
+                input_key = get_input_key(name, stages[name], manifest)
+
+                if name not in force and is_up_to_date(name, input_key, manifest, artifact_dir):
+                    print(f'{name}: up to date, skipping')
+                    done.add(name)
+                    continue
+
+                print(f'{name}: running')
+                futures[name] = (input_key, executor.submit(run_stage, name, stages[name], input_key,
+                                                            manifest, artifact_dir))
+
+            failed = None
+            for name, (input_key, future) in futures.items():
+                try:
+                    manifest[name] = {'input_key': input_key, 'artifact': future.result()}
+                    save_manifest(manifest, artifact_dir)
+                    done.add(name)
+                except Exception as e:
+                    print(f'{name}: failed')
+                    failed = failed or e
+
+            # Stages from this wave that succeeded are checkpointed, so stop here and let a rerun resume
+            if failed is not None:
+                raise failed
+
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the energy data ETL pipeline.')
+    parser.add_argument('--stages', nargs='+', help='Stages to run (with their dependencies). Defaults to all.')
+    parser.add_argument('--force', nargs='+', default=[], help='Stages to rerun even if they are up to date.')
+    parser.add_argument('--jobs', type=int, default=2, help='Maximum number of stages to run in parallel.')
+    parser.add_argument('--seds-path', default='not_for_git/SEDS.txt', help='Path to the EIA SEDS bulk file.')
+    parser.add_argument('--mongo-url', default='mongodb://localhost/', help='MongoDB connection string.')
+    parser.add_argument('--packed', action='store_true', help='Store series as packed float64 bytes.')
+    parser.add_argument('--artifact-dir', default=ARTIFACT_DIR, help='Where to store stage artifacts.')
+    parser.add_argument('--crawl-ttl-days', type=float, default=CRAWL_TTL_DAYS,
+                        help='Days to reuse crawled series ids before crawling again.')
+    args = parser.parse_args()
+
+    stages = get_stages(args.seds_path, args.mongo_url, args.packed, args.crawl_ttl_days)
+    run_pipeline(stages, args.stages, set(args.force), args.jobs, args.artifact_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""
+Lazy, memory-bounded access to per-region data.
+
+The state dataframes pickle has to be loaded whole, which is fine for 50
+states but not for 3,000+ counties. A region store keeps every region's
+{sector: dataframe} dict as its own pickle inside one data file, plus an
+index of byte offsets. RegionStore reads a region from disk the first time
+it is accessed and keeps recently used regions in memory up to a byte
+budget, evicting the least recently used ones beyond that.
+
+RegionStore behaves like the usual {state: {sector: dataframe}} dict, so
+create_timeseries and the scoring code use it unchanged. Memory use then
+depends on the working set rather than the number of regions.
+
+Build a store from the pickle with:
+
+    python region_store.py --pickle cleaned_data/state_dfs.pickle --out cleaned_data/regions
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from collections.abc import Mapping
+
+import caching
+
+INDEX_NAME = 'index.json'
+LOCK_NAME = 'build.lock'
+
+
+def get_region_bytes(region_dfs):
+    """
+    Returns
+    -------
+
+        The approximate memory footprint of a region's dataframes in bytes.
+    """
+    return int(sum(df.memory_usage(index=True, deep=True).sum() for df in region_dfs.values()))
+
+
+@contextmanager
+def lock_region_store(store_dir):
+    """
+    Holds an exclusive lock on the store's lock file, so only one process
+    at a time (e.g. one of several app workers starting together) builds the
+    store. The lock is released when the block exits, or by the OS if the
+    process dies.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+
+    with open(os.path.join(store_dir, LOCK_NAME), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def build_region_store(state_dfs, store_dir):
+    """
+    Writes every region of state_dfs to a new region store in store_dir.
+
+    The data file is named after its contents and the index is replaced
+    last, so a RegionStore that is open on the old files keeps working.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] {region: {sector: dataframe}}
+
+        store_dir: [str] Directory of the store
+    """
+    with lock_region_store(store_dir):
+        _write_region_store(state_dfs, store_dir)
+
+
+def _write_region_store(state_dfs, store_dir):
+    """
+    Does the work of build_region_store(). The caller must hold the store's lock.
+    """
+    # Temporary files get unique names, so nothing is ever written through a path another process uses
+    fd, tmp_path = tempfile.mkstemp(prefix='regions.', suffix='.tmp', dir=store_dir)
+    digest = hashlib.sha1()
+    index = {}
+    offset = 0
+
+    with os.fdopen(fd, 'wb') as f:
+        for region in state_dfs:
+            payload = pickle.dumps(state_dfs[region], protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(payload)
+            digest.update(payload)
+
+            index[region] = {'offset': offset,
+                             'length': len(payload),
+                             'fingerprint': caching.get_region_fingerprint(state_dfs[region])}
+            offset += len(payload)
+
+    data_name = 'regions-' + digest.hexdigest()[:16] + '.bin'
+    os.replace(tmp_path, os.path.join(store_dir, data_name))
+
+    fd, tmp_index_path = tempfile.mkstemp(prefix='index.', suffix='.tmp', dir=store_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'data_file': data_name, 'regions': index}, f)
+    os.replace(tmp_index_path, os.path.join(store_dir, INDEX_NAME))
+
+    # Clean up data files from older builds. Open stores keep their file handle, so this is safe on POSIX.
+    for name in os.listdir(store_dir):
+        if name.startswith('regions-') and name.endswith('.bin') and name != data_name:
+            try:
+                os.remove(os.path.join(store_dir, name))
+            except OSError:
+                pass
+
+
+def ensure_region_store(pickle_path, store_dir):
+    """
+    Builds the region store from the state dataframes pickle if it doesn't
+    exist yet or is older than the pickle. When several processes call this
+    at once, one builds the store and the others wait for it and use it.
+
+    Parameters
+    -----------
+
+        pickle_path: [str] Path to the pickled state dataframes
+
+        store_dir: [str] Directory of the store
+    """
+    index_path = os.path.join(store_dir, INDEX_NAME)
+
+    def is_current():
+        return os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(pickle_path)
+
+    if is_current():
+        return
+
+    with lock_region_store(store_dir):
+        # Another process may have built it while this one waited for the lock
+        if is_current():
+            return
+
+        with open(pickle_path, 'rb') as f:
+            _write_region_store(pickle.load(f), store_dir)
+
+
+class RegionStore(Mapping):
+    """
+    Read-only {region: {sector: dataframe}} mapping backed by a region store on disk.
+    """
+
+    def __init__(self, store_dir, max_bytes=256 * 1024 ** 2):
+        """
+        Parameters
+        -----------
+
+            store_dir: [str] Directory of the store
+
+            max_bytes: [int] Memory budget for resident regions. The most recently
+                       used region is always kept, even if it alone is over budget.
+        """
+        with open(os.path.join(store_dir, INDEX_NAME), 'r') as f:
+            index = json.load(f)
+
+        self.store_dir = store_dir
+        self.index = index['regions']
+        self.max_bytes = max_bytes
+        self.data_file = open(os.path.join(store_dir, index['data_file']), 'rb')
+
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.cache_lock = threading.Lock()
+        self.file_lock = threading.Lock()
+
+    def __getitem__(self, region):
+        with self.cache_lock:
+            if region in self.resident:
+                self.resident.move_to_end(region)
+                self.hits += 1
+                return self.resident[region][0]
+
+        # Raises KeyError for unknown regions, like a dict
+        entry = self.index[region]
+
+        with self.file_lock:
+            self.data_file.seek(entry['offset'])
+            payload = self.data_file.read(entry['length'])
+
+        region_dfs = pickle.loads(payload)
+        size = get_region_bytes(region_dfs)
+
+        with self.cache_lock:
+            self.misses += 1
+
+            # Another thread may have loaded it in the meantime
+            if region not in self.resident:
+                self.resident[region] = (region_dfs, size)
+                self.resident_bytes += size
+
+            while self.resident_bytes > self.max_bytes and len(self.resident) > 1:
+                _, (_, evicted_size) = self.resident.popitem(last=False)
+                self.resident_bytes -= evicted_size
+                self.evictions += 1
+
+            return self.resident.get(region, (region_dfs, size))[0]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, region):
+        return region in self.index
+
+    @property
+    def fingerprints(self):
+        """
+        The fingerprint of every region, read from the index without loading any data.
+        """
+        return {region: entry['fingerprint'] for region, entry in self.index.items()}
+
+    def get_stats(self):
+        """
+        Returns
+        -------
+
+            A dict with residency and hit-rate statistics.
+        """
+        with self.cache_lock:
+            requests = self.hits + self.misses
+            return {'regions': len(self.index),
+                    'resident_regions': len(self.resident),
+                    'resident_bytes': self.resident_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': round(self.hits / requests, 4) if requests else None}
+
+    def close(self):
+        self.data_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a region store from the state dataframes pickle.')
+    parser.add_argument('--pickle', default='cleaned_data/state_dfs.pickle')
+    parser.add_argument('--out', default='cleaned_data/regions')
+    args = parser.parse_args()
+
+    with open(args.pickle, 'rb') as f:
+        build_region_store(pickle.load(f), args.out)
+
+
+if __name__ == '__main__':
+    main()
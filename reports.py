@@ -0,0 +1,316 @@
+"""
+Batch export of per-state report packs.
+
+Renders the figures the dash app shows for a state (energy consumption with
+trend and weather model fit, renewable/nonrenewable by sector and by fuel,
+score trajectory) to
+image files for every state, using the same figure code as the app
+(figures.py). States are spread over a process pool; each worker keeps its
+own image renderer alive, so the renderer's start-up cost is paid once per
+process rather than once per figure.
+
+A manifest in the output directory records the fingerprint each state's
+pack was rendered from. States whose data, weather models and figure code
+haven't changed since the last run are skipped.
+
+Usage:
+
+    python reports.py --out reports --format pdf --jobs 8
+
+Writing images needs kaleido (pip install kaleido).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import plotly.io as pio
+
+import caching
+import figures
+import forecasting
+import region_store
+import scoring
+import weather
+
+MANIFEST_NAME = 'manifest.json'
+
+# Width of every exported figure in pixels; the height comes from the figure layout
+FIGURE_WIDTH = 900
+
+# Modules whose code decides what the figures show: the figures themselves, the
+# trend overlay, the score trajectory and the weather model overlay
+figure_modules = [figures, forecasting, scoring, weather]
+
+
+def get_render_key(image_format, scale):
+    """
+    Returns
+    -------
+
+        A hex digest identifying how figures are rendered: the output format
+        and scale and the code of every module in figure_modules. Changing any
+        of them re-renders every state.
+    """
+    digest = hashlib.sha1()
+    digest.update(f'{image_format}|{scale}|{FIGURE_WIDTH}'.encode())
+
+    for module in figure_modules:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def get_state_figures(state, region_dfs, weather_models=None):
+    """
+    Returns
+    -------
+
+        A list of (name, figure dict) for every figure in the state's report.
+
+    Parameters
+    -----------
+
+        state: [str] e.g. 'New York'
+
+        region_dfs: [dict] {sector: dataframe} of the state
+
+        weather_models: [dict] The state's weather models (see weather.get_state_weather_models()),
+                        overlaid on the consumption chart like in the dash app
+    """
+    # Forecasts and score histories are per series, so the state's own data is all that's needed
+    states_data = {state: region_dfs}
+    forecast_cube = forecasting.get_forecast_cube(states_data)
+    score_history = scoring.get_score_history(scoring.get_score_prefix_sums(states_data))
+
+    state_figures = [(name, figures.build_timeseries(states_data, forecast_cube, case, title, sources, state,
+                                                     weather_models))
+                     for name, case, title, sources in figures.report_timeseries]
+    state_figures.append(('score_trajectory', figures.build_score_trajectory(score_history, state)))
+
+    return state_figures
+
+
+def render_state(state, region_dfs, out_dir, image_format='pdf', scale=1, weather_models=None):
+    """
+    Returns
+    -------
+
+        A tuple (state, list of written file paths relative to out_dir).
+
+        Runs in a worker process.
+
+    Parameters
+    -----------
+
+        state: [str] e.g. 'New York'
+
+        region_dfs: [dict] {sector: dataframe} of the state
+
+        out_dir: [str] Output directory. Files go to out_dir/<state>/<figure name>.<format>
+
+        image_format: [str] 'pdf', 'png' or 'svg'
+
+        scale: [float] Scale factor for raster formats
+
+        weather_models: [dict] The state's weather models, or None
+    """
+    state_dir = os.path.join(out_dir, state)
+    os.makedirs(state_dir, exist_ok=True)
+
+    files = []
+    for name, figure in get_state_figures(state, region_dfs, weather_models):
+        path = os.path.join(state, f'{name}.{image_format}')
+        # The figure was validated when it was built; validating again roughly doubles the cost
+        pio.write_image(figure, os.path.join(out_dir, path), format=image_format,
+                        width=FIGURE_WIDTH, scale=scale, validate=False)
+        files.append(path)
+
+    return state, files
+
+
+def load_manifest(out_dir):
+    """
+    Returns
+    -------
+
+        The manifest of the previous export to out_dir, or an empty one.
+    """
+    path = os.path.join(out_dir, MANIFEST_NAME)
+
+    if not os.path.exists(path):
+        return {'render_key': None, 'states': {}}
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, out_dir):
+    """
+    Writes the manifest atomically, so an interrupted export never leaves a half-written one.
+    """
+    path = os.path.join(out_dir, MANIFEST_NAME)
+
+    # A temporary file of its own, so two exports into the same directory don't clobber each other's
+    fd, tmp_path = tempfile.mkstemp(prefix=MANIFEST_NAME + '.', suffix='.tmp', dir=out_dir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def get_weather_fingerprint(state_models):
+    """
+    Returns
+    -------
+
+        A hex digest of a state's weather models (see weather.get_state_weather_models()), or '' if it has none.
+    """
+    if state_models is None:
+        return ''
+
+    digest = hashlib.sha1(json.dumps(state_models['keys']).encode())
+    digest.update(state_models['years'].tobytes())
+    digest.update(state_models['fitted'].tobytes())
+
+    return digest.hexdigest()
+
+
+def get_stale_states(state_dfs, manifest, render_key, out_dir, weather_models=None):
+    """
+    Returns
+    -------
+
+        A tuple (stale states, fingerprints) where stale states are the ones
+        whose pack is missing or was rendered from different data, weather
+        models or code. A state's fingerprint covers its data and its weather models.
+    """
+    fingerprints = caching.get_region_fingerprints(state_dfs)
+
+    if weather_models is not None:
+        fingerprints = {state: hashlib.sha1((fingerprint + get_weather_fingerprint(
+                                weather.get_state_weather_models(weather_models, state))).encode()).hexdigest()
+                        for state, fingerprint in fingerprints.items()}
+
+    if manifest['render_key'] != render_key:
+        return sorted(fingerprints), fingerprints
+
+    stale = []
+    for state, fingerprint in sorted(fingerprints.items()):
+        entry = manifest['states'].get(state)
+        if (entry is None or entry['fingerprint'] != fingerprint
+                or not all(os.path.exists(os.path.join(out_dir, path)) for path in entry['files'])):
+            stale.append(state)
+
+    return stale, fingerprints
+
+
+def export_reports(state_dfs, out_dir='reports', image_format='pdf', scale=1, jobs=None, force=False,
+                   weather_models=None):
+    """
+    Returns
+    -------
+
+        A dict with the number of rendered and skipped states, the number of
+        figures written, the elapsed time and the throughput in figures per second.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] {state: {sector: dataframe}}, or a region_store.RegionStore
+
+        out_dir: [str] Output directory
+
+        image_format: [str] 'pdf', 'png' or 'svg'
+
+        scale: [float] Scale factor for raster formats
+
+        jobs: [int] Number of worker processes (defaults to the number of CPUs)
+
+        force: [bool] Re-render every state, even if its pack is up to date
+
+        weather_models: [dict] Output of weather.get_weather_models(). Defaults to
+                        weather.get_cached_weather_models(state_dfs), the models the dash app shows.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    if weather_models is None:
+        weather_models = weather.get_cached_weather_models(state_dfs)
+
+    render_key = get_render_key(image_format, scale)
+    manifest = load_manifest(out_dir)
+    stale, fingerprints = get_stale_states(state_dfs, manifest, render_key, out_dir, weather_models)
+    if force:
+        stale = sorted(fingerprints)
+
+    if manifest['render_key'] != render_key:
+        manifest = {'render_key': render_key, 'states': {}}
+
+    # States that no longer exist drop out of the manifest
+    manifest['states'] = {state: entry for state, entry in manifest['states'].items() if state in fingerprints}
+
+    n_figures = 0
+    start = time.perf_counter()
+
+    if stale:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # Each worker only gets its own state's models
+            futures = [executor.submit(render_state, state, state_dfs[state], out_dir, image_format, scale,
+                                       weather.get_state_weather_models(weather_models, state))
+                       for state in stale]
+
+            for future in as_completed(futures):
+                state, files = future.result()
+                manifest['states'][state] = {'fingerprint': fingerprints[state], 'files': files}
+                n_figures += len(files)
+
+                # Checkpoint so an interrupted export resumes where it left off
+                save_manifest(manifest, out_dir)
+    else:
+        save_manifest(manifest, out_dir)
+
+    elapsed = time.perf_counter() - start
+
+    return {'rendered': len(stale),
+            'skipped': len(fingerprints) - len(stale),
+            'figures': n_figures,
+            'seconds': round(elapsed, 2),
+            'figures_per_second': round(n_figures / elapsed, 1) if n_figures else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render report figures for every state.')
+    parser.add_argument('--pickle', default='cleaned_data/state_dfs.pickle')
+    parser.add_argument('--regions', help='Read states lazily from this region store instead of the pickle.')
+    parser.add_argument('--out', default='reports')
+    parser.add_argument('--format', default='pdf', choices=['pdf', 'png', 'svg'])
+    parser.add_argument('--scale', type=float, default=1)
+    parser.add_argument('--jobs', type=int, default=None, help='Worker processes (default: number of CPUs).')
+    parser.add_argument('--force', action='store_true', help='Re-render states that are up to date.')
+    args = parser.parse_args()
+
+    if args.regions:
+        state_dfs = region_store.RegionStore(args.regions)
+    else:
+        with open(args.pickle, 'rb') as f:
+            state_dfs = pickle.load(f)
+
+    summary = export_reports(state_dfs, args.out, args.format, args.scale, args.jobs, args.force)
+
+    print(f'Rendered {summary["rendered"]} states ({summary["figures"]} figures), '
+          f'skipped {summary["skipped"]} unchanged, in {summary["seconds"]}s')
+    if summary['figures_per_second']:
+        print(f'{summary["figures_per_second"]} figures/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,467 @@
+import numpy as np
+import pandas as pd
+
+import helper_functions
+
+
+"""
+WINDOWED SUSTAINABILITY SCORES
+------------------------------
+
+    get_sustainability_indicators() computes the effort and green scores for
+    2000-2017 only. Both scores are built from sums over the years in the
+    window, so by storing running (prefix) sums of everything they need we can
+    get the scores for any window by subtracting two entries:
+
+        Effort score: minus the slope of the yearly integrals of (NEC - REC).
+                      The slope of a least squares line only needs n, Σx, Σy,
+                      Σxy and Σx², which are all prefix-summable.
+
+        Green score:  the mean of REC/NEC, i.e. Σ(REC/NEC) / n.
+
+    Everything is stored as (states x years) numpy arrays so one call can
+    score every state for every window at once. The arrays are views of
+    larger buffers that grow geometrically, so appending a year writes only
+    the new columns instead of copying everything stored so far.
+"""
+
+
+def append_columns(arrays, name, values, new_buffers):
+    """
+    Returns
+    -------
+
+        arrays[name] with values appended along the last axis, as a view of a
+        buffer that doubles in size when it runs out of room, so appending one
+        column costs O(rows) amortized.
+
+        Each dict records in '_buffers' which buffer its arrays are views of
+        and the token it holds on it. Only the dict whose token the buffer
+        currently carries (the last one written from it) may write past its
+        end; any other dict, e.g. one that was already extended once, gets a
+        copy instead. arrays itself is never modified, so every dict keeps its
+        own values no matter which of them are extended later.
+
+    Parameters
+    -----------
+
+        arrays: [dict] Dict of arrays, e.g. the output of get_score_prefix_sums()
+
+        name: [str] Key of the array to extend
+
+        values: [array] Columns to append, same shape as arrays[name] except along the last axis
+
+        new_buffers: [dict] The '_buffers' dict of the dict being built. The buffer record
+                     of the extended array is stored in it.
+    """
+    current = arrays[name]
+    record, token = arrays.get('_buffers', {}).get(name, (None, None))
+
+    n = current.shape[-1]
+    needed = n + values.shape[-1]
+
+    if record is None or record['owner'] is not token or record['buffer'].shape[-1] < needed:
+        buffer = np.empty(current.shape[:-1] + (max(needed, 2 * n, 16),), dtype=current.dtype)
+        buffer[..., :n] = current
+        record = {'buffer': buffer}
+
+    record['buffer'][..., n:needed] = values
+
+    # The new dict now owns the buffer; the one it was extended from has to copy from here on
+    token = object()
+    record['owner'] = token
+    new_buffers[name] = (record, token)
+
+    return record['buffer'][..., :needed]
+
+
+def get_consumption_arrays(state_dfs):
+    """
+    Returns
+    -------
+
+        A tuple (years, rec, nec) with the ascending years and the (states x years)
+        'Total All Sectors' renewable and nonrenewable consumption / 10^5, in the order of state_dfs.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+    """
+    states = list(state_dfs)
+
+    # All states share the same yearly index, so take it from the first one
+    index = state_dfs[states[0]]['Total All Sectors'].sort_index().index
+
+    # Divide by 10^5 to have the same scale as get_sustainability_indicators()
+    rec = np.array([state_dfs[state]['Total All Sectors']['Renewable Sources'].reindex(index).values
+                    for state in states], dtype=float) / 100000
+    nec = np.array([state_dfs[state]['Total All Sectors']['Nonrenewable Sources'].reindex(index).values
+                    for state in states], dtype=float) / 100000
+
+    return np.array(index.year), rec, nec
+
+
+def get_score_prefix_sums(state_dfs):
+    """
+    Returns
+    -------
+
+        A dict with the years, states and prefix sums needed to score any window:
+
+        {'years': array of years (ascending),
+         'states': list of states,
+         'rec': (states x years) renewable consumption / 10^5,
+         'nec': (states x years) nonrenewable consumption / 10^5,
+         'sum_y', 'sum_xy': (states x years + 1) prefix sums of the integrals,
+         'sum_x', 'sum_xx': (years + 1) prefix sums of the (centered) integral years,
+         'sum_ratio': (states x years + 1) prefix sums of REC/NEC
+        }
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+    """
+    states = list(state_dfs)
+    years, rec, nec = get_consumption_arrays(state_dfs)
+
+    prefix_sums = {'years': np.array([], dtype=int),
+                   'states': states,
+                   'rec': np.empty((len(states), 0)),
+                   'nec': np.empty((len(states), 0)),
+                   'sum_y': np.zeros((len(states), 1)),
+                   'sum_xy': np.zeros((len(states), 1)),
+                   'sum_x': np.zeros(1),
+                   'sum_xx': np.zeros(1),
+                   'sum_ratio': np.zeros((len(states), 1))}
+
+    return extend_score_prefix_sums(prefix_sums, years, rec, nec)
+
+
+def extend_score_prefix_sums(prefix_sums, years, rec, nec):
+    """
+    Returns
+    -------
+
+        A new prefix sums dict with the given years appended. Only the new
+        columns are computed and written (see append_columns()), so adding
+        one year costs O(states) amortized. prefix_sums itself is unchanged.
+
+    Parameters
+    -----------
+
+        prefix_sums: [dict] Output of get_score_prefix_sums()
+
+        years: [array] The new years, ascending and following the last stored year
+
+        rec: [array] (states x new years) renewable consumption / 10^5
+
+        nec: [array] (states x new years) nonrenewable consumption / 10^5
+    """
+    years = np.asarray(years)
+    rec = np.asarray(rec, dtype=float).reshape(len(prefix_sums['states']), len(years))
+    nec = np.asarray(nec, dtype=float).reshape(len(prefix_sums['states']), len(years))
+
+    n_old = len(prefix_sums['years'])
+    diff = nec - rec
+
+    # Trapezoid integral between each year and the one before it, same as np.trapz(diff[i:i+2]).
+    # The integral for year t lives in column t; the first year has no integral so it contributes 0.
+    if n_old:
+        previous = prefix_sums['nec'][:, -1:] - prefix_sums['rec'][:, -1:]
+    else:
+        previous = diff[:, :1]
+    integrals = (np.concatenate([previous, diff[:, :-1]], axis=1) + diff) / 2
+
+    # Center years on the first one to keep Σx² small. Slopes don't depend on the shift.
+    first_year = prefix_sums['years'][0] if n_old else years[0]
+    x = (years - first_year).astype(float)
+    has_integral = (np.arange(n_old, n_old + len(years)) > 0).astype(float)
+    integrals[:, has_integral == 0] = 0
+
+    ratios = rec / nec
+
+    buffers = {}
+
+    def append(name, values):
+        prefix = prefix_sums[name]
+        return append_columns(prefix_sums, name, prefix[..., -1:] + np.cumsum(values, axis=-1), buffers)
+
+    return {'years': append_columns(prefix_sums, 'years', years.astype(prefix_sums['years'].dtype), buffers),
+            'states': prefix_sums['states'],
+            'rec': append_columns(prefix_sums, 'rec', rec, buffers),
+            'nec': append_columns(prefix_sums, 'nec', nec, buffers),
+            'sum_y': append('sum_y', integrals),
+            'sum_xy': append('sum_xy', integrals * x),
+            'sum_x': append('sum_x', x * has_integral),
+            'sum_xx': append('sum_xx', x * x * has_integral),
+            'sum_ratio': append('sum_ratio', ratios),
+            '_buffers': buffers}
+
+
+# The effort score regresses the yearly integrals, which needs at least two of them, i.e. three years
+MIN_WINDOW_YEARS = 3
+
+
+def get_window_scores(prefix_sums, starts, ends):
+    """
+    Returns
+    -------
+
+        A tuple (effort_scores, green_scores) of (windows x states) arrays,
+        unrounded. Windows with fewer than 3 years get NaN effort scores,
+        since the regression needs at least 2 integrals. Raises a ValueError
+        if a window starts or ends on a year that isn't stored.
+
+    Parameters
+    -----------
+
+        prefix_sums: [dict] Output of get_score_prefix_sums()
+
+        starts: [int or array] First year of each window (inclusive)
+
+        ends: [int or array] Last year of each window (inclusive)
+    """
+    starts, ends = np.broadcast_arrays(np.atleast_1d(starts), np.atleast_1d(ends))
+    years = prefix_sums['years']
+
+    # Position of each year in the prefix arrays
+    first = np.searchsorted(years, starts)
+    last = np.searchsorted(years, ends)
+
+    # searchsorted snaps a missing year to the next stored one, so check that every bound was found
+    found = ((first < len(years)) & (last < len(years))
+             & (years[np.minimum(first, len(years) - 1)] == starts)
+             & (years[np.minimum(last, len(years) - 1)] == ends))
+    if not found.all():
+        i = np.argmin(found)
+        stored = f'{years[0]}-{years[-1]}' if len(years) else 'none'
+        raise ValueError(f'A score window has to start and end on stored years ({stored}), '
+                         f'got {starts[i]}-{ends[i]}')
+
+    last = last + 1
+
+    """
+    GREEN SCORE
+    -----------
+    """
+    n_years = (last - first).astype(float)
+    green = (prefix_sums['sum_ratio'][:, last] - prefix_sums['sum_ratio'][:, first]) / n_years
+
+    """
+    EFFORT SCORE
+    ------------
+    """
+    # The integral for the first year of the window reaches back outside the window, so skip it
+    lo = first + 1
+
+    n = (last - lo).astype(float)
+    sum_x = prefix_sums['sum_x'][last] - prefix_sums['sum_x'][lo]
+    sum_xx = prefix_sums['sum_xx'][last] - prefix_sums['sum_xx'][lo]
+    sum_y = prefix_sums['sum_y'][:, last] - prefix_sums['sum_y'][:, lo]
+    sum_xy = prefix_sums['sum_xy'][:, last] - prefix_sums['sum_xy'][:, lo]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x ** 2)
+
+    slope[:, n < 2] = np.nan
+
+    return -1 * slope.T, green.T
+
+
+def get_window_indicators(prefix_sums, start, end):
+    """
+    Returns
+    -------
+
+        A dict with the green score and effort score of every state for the given
+        window, in the same format as helper_functions.get_sustainability_indicators().
+
+    Parameters
+    -----------
+
+        prefix_sums: [dict] Output of get_score_prefix_sums()
+
+        start: [int] First year of the window
+
+        end: [int] Last year of the window
+    """
+    effort, green = get_window_scores(prefix_sums, start, end)
+
+    return {state: {'effort_score': round(effort[0, i], 3), 'green_score': round(green[0, i], 3)}
+            for i, state in enumerate(prefix_sums['states'])}
+
+
+def get_window_sustainability_df(prefix_sums, start, end):
+    """
+    Returns
+    -------
+
+        A df with green score, effort score, and sustainability indexes for each
+        state, computed over the given window. For 2000-2017 this is the same
+        table as helper_functions.get_sustainability_df().
+
+    Parameters
+    -----------
+
+        prefix_sums: [dict] Output of get_score_prefix_sums()
+
+        start: [int] First year of the window
+
+        end: [int] Last year of the window
+    """
+    if end - start + 1 < MIN_WINDOW_YEARS:
+        raise ValueError(f'A score window needs at least {MIN_WINDOW_YEARS} years, got {start}-{end}')
+
+    sus_indicators = get_window_indicators(prefix_sums, start, end)
+
+    return helper_functions.get_sustainability_df(sus_indicators)
+
+
+"""
+SCORE HISTORY
+-------------
+
+    A per-state, per-year history of the scores. The score for a year is
+    computed over the trailing window ending in that year, with the same
+    length as the 2000-2017 window used everywhere else. Like the prefix
+    sums it's stored as (states x years) arrays, so a new year is appended
+    without copying the history.
+"""
+
+HISTORY_WINDOW = 18
+
+
+def get_score_history(prefix_sums, window=HISTORY_WINDOW, years=None):
+    """
+    Returns
+    -------
+
+        A dict with the trailing-window scores of every state, for every year that has a full window:
+
+        {'years': array of window end years (ascending),
+         'states': list of states,
+         'window': number of years in each window,
+         'effort_score', 'green_score': (states x years) float32 arrays
+        }
+
+    Parameters
+    -----------
+
+        prefix_sums: [dict] Output of get_score_prefix_sums()
+
+        window: [int] Number of years in each trailing window
+
+        years: [array] Only compute these end years. Defaults to every year with a full window.
+    """
+    if years is None:
+        years = prefix_sums['years'][window - 1:]
+
+    years = np.asarray(years, dtype=int)
+    effort, green = get_window_scores(prefix_sums, years - window + 1, years)
+
+    # Stored as float32 to keep the history small
+    return {'years': years,
+            'states': prefix_sums['states'],
+            'window': window,
+            'effort_score': effort.T.astype(np.float32),
+            'green_score': green.T.astype(np.float32),
+            '_buffers': {}}
+
+
+def get_state_score_history(score_history, state):
+    """
+    Returns
+    -------
+
+        A dataframe indexed by window end year with the state's effort_score and green_score.
+
+    Parameters
+    -----------
+
+        score_history: [dict] Output of get_score_history()
+
+        state: [str] e.g. 'New York'
+    """
+    i = score_history['states'].index(state)
+
+    return pd.DataFrame({'effort_score': score_history['effort_score'][i],
+                         'green_score': score_history['green_score'][i]},
+                        index=pd.Index(score_history['years'], name='year'))
+
+
+def append_score_year(prefix_sums, score_history, year, rec, nec):
+    """
+    Returns
+    -------
+
+        A tuple (prefix_sums, score_history) with a new year of data added.
+        Only the new year's columns are computed and written, so this costs
+        O(states) amortized. The inputs are unchanged.
+
+    Parameters
+    -----------
+
+        prefix_sums: [dict] Output of get_score_prefix_sums()
+
+        score_history: [dict] Output of get_score_history() for prefix_sums
+
+        year: [int] The new year, immediately following the last stored year
+
+        rec: [array] Renewable consumption of every state in the new year / 10^5
+
+        nec: [array] Nonrenewable consumption of every state in the new year / 10^5
+    """
+    prefix_sums = extend_score_prefix_sums(prefix_sums, [year], rec, nec)
+    new_scores = get_score_history(prefix_sums, score_history['window'], years=[year])
+    buffers = {}
+
+    return prefix_sums, dict(score_history,
+                             years=append_columns(score_history, 'years', new_scores['years'], buffers),
+                             effort_score=append_columns(score_history, 'effort_score',
+                                                         new_scores['effort_score'], buffers),
+                             green_score=append_columns(score_history, 'green_score',
+                                                        new_scores['green_score'], buffers),
+                             _buffers=buffers)
+
+
+def update_score_history(prefix_sums, score_history, state_dfs):
+    """
+    Returns
+    -------
+
+        A tuple (prefix_sums, score_history) for state_dfs.
+
+        When state_dfs holds the same states and the same data for every
+        stored year, plus one or more later years (the usual yearly ETL
+        update), the new years are added with append_score_year(). Otherwise
+        both are recomputed with get_score_prefix_sums() and get_score_history().
+
+    Parameters
+    -----------
+
+        prefix_sums: [dict] Output of get_score_prefix_sums() for the previous data
+
+        score_history: [dict] Output of get_score_history() for prefix_sums
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+    """
+    years, rec, nec = get_consumption_arrays(state_dfs)
+    n_old = len(prefix_sums['years'])
+
+    # Everything already stored is still valid
+    stored_unchanged = (list(state_dfs) == prefix_sums['states']
+                        and len(years) >= n_old
+                        and np.array_equal(years[:n_old], prefix_sums['years'])
+                        and np.array_equal(rec[:, :n_old], prefix_sums['rec'], equal_nan=True)
+                        and np.array_equal(nec[:, :n_old], prefix_sums['nec'], equal_nan=True))
+
+    if not stored_unchanged:
+        prefix_sums = get_score_prefix_sums(state_dfs)
+        return prefix_sums, get_score_history(prefix_sums, score_history['window'])
+
+    for t in range(n_old, len(years)):
+        prefix_sums, score_history = append_score_year(prefix_sums, score_history, years[t], rec[:, t], nec[:, t])
+
+    return prefix_sums, score_history
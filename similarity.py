@@ -0,0 +1,334 @@
+import numpy as np
+
+from sklearn.cluster import MiniBatchKMeans
+
+import caching
+
+
+"""
+SIMILAR REGIONS
+---------------
+
+    Finds the regions whose renewable and nonrenewable consumption
+    trajectories look most like a given region's.
+
+    Each region is turned into one vector: its 'Total All Sectors' renewable
+    and nonrenewable series, each standardized so that only the shape of the
+    trajectory matters and not the size of the region, concatenated and
+    scaled to unit length. The similarity of two regions is then the dot
+    product of their vectors (the average correlation of their series).
+
+    For up to a few thousand regions every query simply scores all vectors
+    with one matrix-vector product. Beyond that the index is partitioned
+    around k-means centroids (an inverted file index) and a query only scores
+    the regions in the partitions closest to it. Regions are inserted or
+    replaced one at a time, so a change in a region's data doesn't require
+    rebuilding the index.
+"""
+
+trajectory_sources = ['Renewable Sources', 'Nonrenewable Sources']
+
+# Above this many regions queries go through the inverted file index
+EXACT_SEARCH_LIMIT = 5000
+
+CACHE_NAME = 'similarity_index'
+
+
+def get_trajectory_vector(region_dfs):
+    """
+    Returns
+    -------
+
+        A unit length float32 vector of the region's standardized renewable
+        and nonrenewable 'Total All Sectors' series.
+
+    Parameters
+    -----------
+
+        region_dfs: [dict] {sector: dataframe} for a single region
+    """
+    total_df = region_dfs['Total All Sectors'].sort_index()
+    series = total_df[trajectory_sources].values.astype(float).T
+
+    # Standardize each series. Flat series carry no shape, so they become zeros.
+    std = series.std(axis=1, keepdims=True)
+    std[std == 0] = np.inf
+    series = np.nan_to_num((series - series.mean(axis=1, keepdims=True)) / std)
+
+    vector = series.ravel()
+    norm = np.linalg.norm(vector)
+
+    return (vector / norm if norm else vector).astype(np.float32)
+
+
+class SimilarityIndex:
+    """
+    Nearest neighbour index over region trajectory vectors, with exact search
+    for small collections and an inverted file index for large ones.
+    """
+
+    def __init__(self, exact_search_limit=EXACT_SEARCH_LIMIT, n_probe=8, random_state=10):
+        """
+        Parameters
+        -----------
+
+            exact_search_limit: [int] Largest number of regions that is searched exhaustively
+
+            n_probe: [int] Number of partitions searched per query once the index is partitioned
+
+            random_state: [int] Seed for the k-means partitioning
+        """
+        self.exact_search_limit = exact_search_limit
+        self.n_probe = n_probe
+        self.random_state = random_state
+
+        self.regions = []
+        self.positions = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.occupied = np.zeros(0, dtype=bool)
+        self.size = 0
+
+        # Inverted file index, built once the collection outgrows exact search
+        self.centroids = None
+        self.assignments = None
+        self.partitions = None
+        self.partition_blocks = None
+        self.partitioned_size = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, region):
+        return region in self.positions
+
+    def insert(self, region, vector):
+        """
+        Adds a region, or replaces its vector if it's already in the index.
+
+        Parameters
+        -----------
+
+            region: [str] Region name
+
+            vector: [array] Output of get_trajectory_vector()
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+
+        if self.size == 0:
+            self.vectors = np.zeros((16, len(vector)), dtype=np.float32)
+            self.occupied = np.zeros(16, dtype=bool)
+        elif self.vectors.shape[1] != len(vector):
+            raise ValueError(f'Expected a vector of length {self.vectors.shape[1]}, got {len(vector)}')
+
+        if region in self.positions:
+            position = self.positions[region]
+        else:
+            # Grow the storage geometrically so inserts stay cheap
+            if self.size == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+                self.occupied = np.concatenate([self.occupied, np.zeros_like(self.occupied)])
+            position = self.size
+            self.size += 1
+            self.regions.append(region)
+            self.positions[region] = position
+
+        self.vectors[position] = vector
+        self.occupied[position] = True
+
+        # Repartition as the index grows, so partitions stay around sqrt(regions) in size
+        if len(self) > max(self.exact_search_limit, 4 * self.partitioned_size):
+            self.partition()
+        elif self.centroids is not None:
+            self._assign(position)
+
+    def remove(self, region):
+        """
+        Removes a region from the index. Its slot is left empty rather than
+        compacted, so the positions of other regions don't change.
+        """
+        position = self.positions.pop(region)
+        self.vectors[position] = 0
+        self.occupied[position] = False
+        self.regions[position] = None
+
+        if self.centroids is not None:
+            self.partitions[self.assignments[position]].discard(position)
+            self.partition_blocks[self.assignments[position]] = None
+            self.assignments[position] = -1
+
+    def partition(self, n_partitions=None):
+        """
+        Builds the inverted file index: clusters the vectors around
+        n_partitions centroids (sqrt of the number of regions by default) and
+        files every region under its nearest centroid.
+        """
+        live = np.array(sorted(self.positions.values()))
+        if n_partitions is None:
+            n_partitions = max(1, int(np.sqrt(len(live))))
+
+        model = MiniBatchKMeans(n_clusters=n_partitions, random_state=self.random_state,
+                                batch_size=1024, n_init=3)
+        model.fit(self.vectors[live])
+
+        self.centroids = model.cluster_centers_.astype(np.float32)
+        self.assignments = np.full(len(self.vectors), -1)
+        self.partitions = [set() for _ in range(n_partitions)]
+        self.partition_blocks = [None] * n_partitions
+        self.partitioned_size = len(live)
+
+        # File every region under its nearest centroid at once
+        self.assignments[live] = model.predict(self.vectors[live])
+        for position in live:
+            self.partitions[self.assignments[position]].add(position)
+
+    def _assign(self, position):
+        """
+        Files the region at position under its nearest centroid.
+        """
+        if len(self.assignments) < len(self.vectors):
+            self.assignments = np.concatenate([self.assignments,
+                                               np.full(len(self.vectors) - len(self.assignments), -1)])
+
+        old = self.assignments[position]
+        if old >= 0:
+            self.partitions[old].discard(position)
+            self.partition_blocks[old] = None
+
+        # Nearest centroid by Euclidean distance
+        new = int(np.argmin(((self.centroids - self.vectors[position]) ** 2).sum(axis=1)))
+        self.assignments[position] = new
+        self.partitions[new].add(position)
+        self.partition_blocks[new] = None
+
+    def _get_partition_block(self, partition):
+        """
+        Returns a tuple (positions, vectors) of the regions filed under partition.
+        Cached until the partition changes, so queries don't have to gather
+        scattered rows out of the full vector matrix.
+        """
+        if self.partition_blocks[partition] is None:
+            positions = np.fromiter(self.partitions[partition], dtype=int, count=len(self.partitions[partition]))
+            self.partition_blocks[partition] = (positions, self.vectors[positions])
+
+        return self.partition_blocks[partition]
+
+    def query(self, vector, k=5, exclude=None):
+        """
+        Returns
+        -------
+
+            A list of up to k (region, similarity) tuples, most similar first.
+
+        Parameters
+        -----------
+
+            vector: [array] Output of get_trajectory_vector()
+
+            k: [int] Number of neighbours
+
+            exclude: [str] Region to leave out, typically the one being queried
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+
+        if self.centroids is None:
+            candidates = np.arange(self.size)
+            scores = self.vectors[:self.size] @ vector
+        else:
+            nearest = np.argsort(((self.centroids - vector) ** 2).sum(axis=1))[:self.n_probe]
+            blocks = [self._get_partition_block(partition) for partition in nearest]
+            candidates = np.concatenate([positions for positions, _ in blocks])
+            scores = np.concatenate([block @ vector for _, block in blocks])
+
+        # Empty slots and the excluded region never make the list
+        scores[~self.occupied[candidates]] = -np.inf
+        if exclude in self.positions:
+            scores[candidates == self.positions[exclude]] = -np.inf
+
+        k = min(k, int(np.isfinite(scores).sum()))
+        top = np.argpartition(-scores, k - 1)[:k] if k else []
+        top = sorted(top, key=lambda i: -scores[i])
+
+        return [(self.regions[candidates[i]], round(float(scores[i]), 4)) for i in top]
+
+    def get_similar(self, region, k=5):
+        """
+        Returns
+        -------
+
+            A list of up to k (region, similarity) tuples for the regions most similar to region.
+        """
+        return self.query(self.vectors[self.positions[region]], k, exclude=region)
+
+
+def build_similarity_index(state_dfs, **kwargs):
+    """
+    Returns
+    -------
+
+        A SimilarityIndex with every region of state_dfs.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+
+        **kwargs: Passed on to SimilarityIndex()
+    """
+    index = SimilarityIndex(**kwargs)
+    for region in state_dfs:
+        index.insert(region, get_trajectory_vector(state_dfs[region]))
+
+    return index
+
+
+def get_similarity_index(state_dfs, changed_regions=None, cache_dir=caching.CACHE_DIR):
+    """
+    Returns
+    -------
+
+        A SimilarityIndex with every region of state_dfs.
+
+        The index is cached along with the data fingerprints it was built
+        from. On later calls only regions that changed are reinserted (or
+        removed), like clustering.get_cluster_labels().
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+
+        changed_regions: [iterable] Regions the ETL reports as changed. If None, changes are
+                         detected by comparing fingerprints with the cached ones.
+
+        cache_dir: [str] Directory the cache lives in
+    """
+    fingerprints = caching.get_region_fingerprints(state_dfs)
+    cached = caching.load_cache(CACHE_NAME, cache_dir)
+
+    if cached is None:
+        index = build_similarity_index(state_dfs)
+
+    else:
+        if changed_regions is None:
+            changed_regions = caching.get_changed_regions(cached['fingerprints'], fingerprints)
+
+        if not changed_regions:
+            return cached['index']
+
+        index = cached['index']
+        updated = {region: get_trajectory_vector(state_dfs[region]) for region in changed_regions
+                   if region in state_dfs}
+
+        # A change in the number of years means every vector has to be rebuilt
+        if any(len(vector) != index.vectors.shape[1] for vector in updated.values()):
+            index = build_similarity_index(state_dfs)
+        else:
+            for region, vector in updated.items():
+                index.insert(region, vector)
+            for region in changed_regions:
+                if region not in state_dfs and region in index:
+                    index.remove(region)
+
+    caching.save_cache(CACHE_NAME, {'fingerprints': fingerprints, 'index': index}, cache_dir)
+
+    return index
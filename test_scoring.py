@@ -0,0 +1,124 @@
+import numpy as np
+
+import scoring
+
+
+"""
+SCORE PREFIX SUMS
+-----------------
+
+    Regression tests for extending prefix sums and score histories, which
+    share growable buffers between the dicts they return.
+
+    scoring imports helper_functions, so these need the same MongoDB
+    connection as the rest of the project. Run with:
+
+        python -m pytest test_scoring.py
+"""
+
+
+def get_empty_prefix_sums(n_states=3):
+    """
+    Returns
+    -------
+
+        Prefix sums with no years yet, as get_score_prefix_sums() starts from.
+    """
+    return {'years': np.array([], dtype=int),
+            'states': [f'State {i}' for i in range(n_states)],
+            'rec': np.empty((n_states, 0)),
+            'nec': np.empty((n_states, 0)),
+            'sum_y': np.zeros((n_states, 1)),
+            'sum_xy': np.zeros((n_states, 1)),
+            'sum_x': np.zeros(1),
+            'sum_xx': np.zeros(1),
+            'sum_ratio': np.zeros((n_states, 1))}
+
+
+def get_base_prefix_sums(n_states=3, n_years=18):
+    """
+    Returns
+    -------
+
+        Prefix sums over made-up consumption for n_states states, from 2000 on.
+    """
+    years = np.arange(2000, 2000 + n_years)
+    rng = np.random.default_rng(0)
+    rec = rng.uniform(1, 2, (n_states, 18))[:, :n_years]
+    nec = rng.uniform(3, 4, (n_states, 18))[:, :n_years]
+
+    return scoring.extend_score_prefix_sums(get_empty_prefix_sums(n_states), years, rec, nec)
+
+
+def test_extending_the_same_prefix_sums_twice_keeps_branches_apart():
+    base = get_base_prefix_sums()
+    n_states = len(base['states'])
+    base_rec = base['rec'].copy()
+    base_keys = set(base)
+
+    a = scoring.extend_score_prefix_sums(base, [2018], np.full(n_states, 1.0), np.full(n_states, 10.0))
+    b = scoring.extend_score_prefix_sums(base, [2018], np.full(n_states, 5.0), np.full(n_states, 10.0))
+    c = scoring.extend_score_prefix_sums(a, [2019], np.full(n_states, 2.0), np.full(n_states, 10.0))
+
+    assert np.all(a['rec'][:, -1] == 1.0)
+    assert np.all(b['rec'][:, -1] == 5.0)
+    assert np.all(c['rec'][:, -2] == 1.0)
+    assert np.all(c['rec'][:, -1] == 2.0)
+
+    # Extending again after the other branches doesn't disturb them either
+    d = scoring.extend_score_prefix_sums(b, [2019], np.full(n_states, 7.0), np.full(n_states, 10.0))
+    assert np.all(d['rec'][:, -2:] == [5.0, 7.0])
+    assert np.all(c['rec'][:, -2:] == [1.0, 2.0])
+
+    # The dict that was extended is unchanged
+    assert set(base) == base_keys
+    assert np.array_equal(base['rec'], base_rec)
+    assert len(base['years']) == 18
+
+
+def test_extended_prefix_sums_match_a_full_recompute():
+    base = get_base_prefix_sums(n_years=11)
+    full = get_base_prefix_sums()
+
+    extended = base
+    for t in range(len(base['years']), len(full['years'])):
+        extended = scoring.extend_score_prefix_sums(extended, [full['years'][t]],
+                                                    full['rec'][:, t], full['nec'][:, t])
+
+    for name in ['years', 'rec', 'nec', 'sum_y', 'sum_xy', 'sum_x', 'sum_xx', 'sum_ratio']:
+        assert np.allclose(extended[name], full[name])
+
+
+def test_appending_score_years_to_the_same_history_twice_keeps_branches_apart():
+    prefix_sums = get_base_prefix_sums()
+    history = scoring.get_score_history(prefix_sums, window=5)
+    n_states = len(prefix_sums['states'])
+
+    ps_a, history_a = scoring.append_score_year(prefix_sums, history, 2018,
+                                                np.full(n_states, 1.0), np.full(n_states, 10.0))
+    ps_b, history_b = scoring.append_score_year(prefix_sums, history, 2018,
+                                                np.full(n_states, 5.0), np.full(n_states, 10.0))
+    _, history_c = scoring.append_score_year(ps_a, history_a, 2019,
+                                             np.full(n_states, 2.0), np.full(n_states, 10.0))
+
+    assert np.array_equal(history_c['green_score'][:, -2], history_a['green_score'][:, -1])
+    assert not np.array_equal(history_a['green_score'][:, -1], history_b['green_score'][:, -1])
+    assert len(history['years']) == 14
+
+
+def test_windows_outside_the_stored_years_are_rejected():
+    prefix_sums = get_base_prefix_sums()
+    missing = np.delete(np.arange(2000, 2018), 5)
+    gappy = scoring.extend_score_prefix_sums(get_empty_prefix_sums(), missing,
+                                             np.ones((3, len(missing))), np.full((3, len(missing)), 2.0))
+
+    for bad_prefix_sums, start, end in [(prefix_sums, 2000, 2018), (prefix_sums, 1999, 2017),
+                                        (gappy, 2005, 2010), (gappy, 2000, 2005)]:
+        try:
+            scoring.get_window_scores(bad_prefix_sums, start, end)
+        except ValueError:
+            continue
+        raise AssertionError(f'{start}-{end} should have been rejected')
+
+    effort, green = scoring.get_window_scores(prefix_sums, [2000, 2010], 2017)
+    assert effort.shape == green.shape == (2, 3)
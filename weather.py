@@ -0,0 +1,349 @@
+import numpy as np
+import pandas as pd
+
+import caching
+import forecasting
+import helper_functions
+
+
+"""
+WEATHER SENSITIVITY
+-------------------
+
+    Regresses each state's yearly energy consumption on that state's weather:
+    threshold-day counts and mean/std temperature, plus a linear time trend
+    so the weather coefficients aren't picking up long-run growth.
+
+    Every series of a state (sector x energy type) shares the state's weather,
+    so the design matrix is the same for all of them. The states' design
+    matrices are stacked into one (states x years x features) array and every
+    model is solved at once with a batched pseudo-inverse, the same way
+    forecasting.py fits its trends.
+"""
+
+# Weather columns used as regressors by default (see helper_functions.get_weather_df)
+weather_features = ['days_above_90', 'days_below_35', 'Mean Temp', 'Std Temp']
+
+# Energy types the models are fitted for by default
+model_energy_types = ['Renewable Sources', 'Nonrenewable Sources']
+
+CACHE_NAME = 'weather_models'
+
+
+def get_weather_dfs(collection=None):
+    """
+    Returns
+    -------
+
+        A dict {state: weather dataframe} for every state with temperature data in MongoDB.
+
+    Parameters
+    -----------
+
+        collection: [pymongo.collection.Collection] Collection with the temperature documents.
+                    Defaults to helper_functions.energy_collection
+    """
+    if collection is None:
+        collection = helper_functions.energy_collection
+
+    weather_dfs = {}
+    for document in collection.find({'description': 'Temperature'}):
+        # Temperature documents may be keyed by state code rather than name
+        state = helper_functions.state_abbrevs_dict.get(document['state'], document['state'])
+        weather_dfs[state] = helper_functions.get_weather_df([document])
+
+    return weather_dfs
+
+
+def get_weather_cube(weather_dfs, states, years, features=weather_features):
+    """
+    Returns
+    -------
+
+        A (states x years x features) array of weather features. Years without
+        weather data are NaN.
+
+    Parameters
+    -----------
+
+        weather_dfs: [dict] Output of get_weather_dfs()
+
+        states: [list] States in the order of the first axis
+
+        years: [array] Years in the order of the second axis
+
+        features: [list] Weather columns to use
+    """
+    cube = np.full((len(states), len(years), len(features)), np.nan)
+
+    for i, state in enumerate(states):
+        df = weather_dfs[state]
+        df = df.set_axis(df.index.year).reindex(years)
+        cube[i] = df[features].values
+
+    return cube
+
+
+def get_design_cube(weather_cube, years):
+    """
+    Returns
+    -------
+
+        The (states x years x (features + 2)) design matrices: an intercept,
+        a centered year trend and the weather features.
+    """
+    n_states, n_years, _ = weather_cube.shape
+
+    intercept = np.ones((n_states, n_years, 1))
+    trend = np.broadcast_to((years - years.mean())[None, :, None], (n_states, n_years, 1))
+
+    return np.concatenate([intercept, trend, weather_cube], axis=2)
+
+
+def fit_panel(design, targets):
+    """
+    Returns
+    -------
+
+        A tuple (coef, stderr, r2, fitted) where coef and stderr are (states x
+        parameters x series) arrays, r2 is (states x series) and fitted is
+        (states x years x series).
+
+    Parameters
+    -----------
+
+        design: [array] (states x years x parameters) design matrices, without missing values
+
+        targets: [array] (states x years x series) consumption, without missing values
+    """
+    n_years, n_params = design.shape[1:]
+
+    # One pseudo-inverse per state, shared by all of its series
+    pinv = np.linalg.pinv(design)
+    coef = pinv @ targets
+
+    fitted = design @ coef
+    residuals = targets - fitted
+    ssr = (residuals ** 2).sum(axis=1)
+    sst = ((targets - targets.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+
+    # Usual OLS standard errors: sigma^2 * diag((X'X)^-1), and (X'X)^-1 = pinv pinv'
+    sigma2 = ssr / max(n_years - n_params, 1)
+    xtx_inv_diag = (pinv ** 2).sum(axis=2)
+    stderr = np.sqrt(xtx_inv_diag[:, :, None] * sigma2[:, None, :])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = np.where(sst > 0, 1 - ssr / sst, np.nan)
+
+    return coef, stderr, r2, fitted
+
+
+def get_weather_models(state_dfs, weather_dfs, features=weather_features, energy_types=model_energy_types,
+                       start=1960, end=2017):
+    """
+    Returns
+    -------
+
+        A dict with the fitted weather sensitivity models of every state x sector x energy type:
+
+            keys: list of (state, sector, energy_type) tuples, one per model
+            params: names of the parameters ('Intercept', 'Trend', then the weather features)
+            years: array of the years the models were fitted on
+            coef: (models x parameters) array of coefficients
+            stderr: (models x parameters) array of standard errors
+            r2: (models,) array of R^2
+            fitted: (models x years) array of fitted consumption
+            positions: {(state, sector, energy_type): row} lookup table
+
+        The models are read from concurrent dash callbacks, so they are
+        complete when returned and never written to afterwards.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+
+        weather_dfs: [dict] Output of get_weather_dfs()
+
+        features: [list] Weather columns to use as regressors
+
+        energy_types: [list] Energy types to fit models for
+
+        start: [int] First year of the fit
+
+        end: [int] Last year of the fit
+    """
+    keys, years, values = forecasting.get_series_cube(state_dfs)
+
+    in_window = (years >= start) & (years <= end)
+    years = years[in_window]
+    values = values[:, in_window]
+
+    states = [state for state in state_dfs if state in weather_dfs]
+    weather_cube = get_weather_cube(weather_dfs, states, years, features)
+
+    # Years every state has weather for, so the states can share one stack of design matrices
+    complete_years = ~np.isnan(weather_cube).any(axis=(0, 2))
+    years = years[complete_years]
+    values = values[:, complete_years]
+    design = get_design_cube(weather_cube[:, complete_years], years)
+
+    # Arrange the series as (states x years x series per state), in the same order for every state
+    state_positions = {state: i for i, state in enumerate(states)}
+    series = sorted({(sector, energy_type) for state, sector, energy_type in keys if energy_type in energy_types})
+    series_positions = {key: i for i, key in enumerate(series)}
+
+    targets = np.full((len(states), len(years), len(series)), np.nan)
+    for row, (state, sector, energy_type) in enumerate(keys):
+        if state in state_positions and (sector, energy_type) in series_positions:
+            targets[state_positions[state], :, series_positions[(sector, energy_type)]] = values[row]
+
+    # Missing consumption is rare; treat it as zero like create_energy_columns() does when summing
+    targets = np.nan_to_num(targets)
+
+    coef, stderr, r2, fitted = fit_panel(design, targets)
+
+    model_keys = [(state, sector, energy_type) for state in states for sector, energy_type in series]
+
+    return {'keys': model_keys,
+            'params': ['Intercept', 'Trend'] + list(features),
+            'years': years,
+            'coef': coef.transpose(0, 2, 1).reshape(len(model_keys), -1),
+            'stderr': stderr.transpose(0, 2, 1).reshape(len(model_keys), -1),
+            'r2': r2.reshape(-1),
+            'fitted': fitted.transpose(0, 2, 1).reshape(len(model_keys), -1),
+            'positions': {key: i for i, key in enumerate(model_keys)}}
+
+
+def get_cached_weather_models(state_dfs, weather_dfs=None, cache_dir=caching.CACHE_DIR, **kwargs):
+    """
+    Returns
+    -------
+
+        The output of get_weather_models(), loaded from the cache if it was already
+        computed for this energy data, this weather data and these arguments.
+        None if there is no weather data.
+
+    Parameters
+    -----------
+
+        state_dfs: [dict] Output of helper_functions.get_states_data()
+
+        weather_dfs: [dict] Output of get_weather_dfs(). Loaded from MongoDB if not given.
+
+        cache_dir: [str] Directory the cache lives in
+
+        **kwargs: Passed on to get_weather_models()
+    """
+    if weather_dfs is None:
+        weather_dfs = get_weather_dfs()
+
+    if not weather_dfs:
+        return None
+
+    version = (caching.get_dataset_version(state_dfs),
+               caching.get_dataset_version({state: {'weather': df} for state, df in weather_dfs.items()}))
+
+    cached = caching.load_cache(CACHE_NAME, cache_dir)
+    # Models cached before they carried their lookup table are refitted
+    if (cached is not None and cached['version'] == version and cached['params'] == kwargs
+            and 'positions' in cached['models']):
+        return cached['models']
+
+    models = get_weather_models(state_dfs, weather_dfs, **kwargs)
+
+    caching.save_cache(CACHE_NAME, {'version': version, 'params': kwargs, 'models': models}, cache_dir)
+
+    return models
+
+
+def get_weather_sensitivity_df(models, sector='Total All Sectors', energy_type=None):
+    """
+    Returns
+    -------
+
+        A dataframe with one row per model and a column for every coefficient,
+        its standard error ('<param> SE') and R^2, indexed by (state, sector, energy_type).
+
+    Parameters
+    -----------
+
+        models: [dict] Output of get_weather_models()
+
+        sector: [str] Only keep models of this sector (None for all)
+
+        energy_type: [str] Only keep models of this energy type (None for all)
+    """
+    index = pd.MultiIndex.from_tuples(models['keys'], names=['state', 'sector', 'energy_type'])
+
+    df = pd.concat([pd.DataFrame(models['coef'], index=index, columns=models['params']),
+                    pd.DataFrame(models['stderr'], index=index, columns=[param + ' SE' for param in models['params']])],
+                   axis=1)
+    df['R2'] = models['r2']
+
+    if sector is not None:
+        df = df[df.index.get_level_values('sector') == sector]
+    if energy_type is not None:
+        df = df[df.index.get_level_values('energy_type') == energy_type]
+
+    return df
+
+
+def get_series_weather_fit(models, state, sector, energy_type):
+    """
+    Returns
+    -------
+
+        A series indexed by year with the consumption the weather model fits for
+        this series, or None if there is no model for it.
+
+    Parameters
+    -----------
+
+        models: [dict] Output of get_weather_models()
+
+        state: [str] e.g. 'New York'
+
+        sector: [str] e.g. 'Total All Sectors'
+
+        energy_type: [str] e.g. 'Renewable Sources'
+    """
+    i = models['positions'].get((state, sector, energy_type))
+    if i is None:
+        return None
+
+    return pd.Series(models['fitted'][i], index=models['years'])
+
+
+def get_state_weather_models(models, state):
+    """
+    Returns
+    -------
+
+        The models of a single state, in the same format as get_weather_models(),
+        or None if there are no models for the state.
+
+    Parameters
+    -----------
+
+        models: [dict] Output of get_weather_models(), or None
+
+        state: [str] e.g. 'New York'
+    """
+    if models is None:
+        return None
+
+    rows = [i for i, key in enumerate(models['keys']) if key[0] == state]
+    if not rows:
+        return None
+
+    keys = [models['keys'][i] for i in rows]
+
+    return {'keys': keys,
+            'params': models['params'],
+            'years': models['years'],
+            'coef': models['coef'][rows],
+            'stderr': models['stderr'][rows],
+            'r2': models['r2'][rows],
+            'fitted': models['fitted'][rows],
+            'positions': {key: i for i, key in enumerate(keys)}}